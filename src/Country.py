@@ -1,4 +1,8 @@
 from data import *
+from engine import simulate_arrays, simulate_batch, scenario_grid, initial_infected
+import jit_engine
+import profiling
+from integrators import integrate
 
 
 class Country:
@@ -50,6 +54,7 @@ class Country:
         self.R[t] = self.R[t - 1] + dR
 
 
+@profiling.timed('migration')
 def migration(t, countries, mig):
     """
     Method simulating the exchanges of population due to the migration between the different countries at time step t.
@@ -60,6 +65,7 @@ def migration(t, countries, mig):
     :param mig: the migration matrix containing the number of daily movers between each pair of country for each time step
     """
     n = len(countries)
+    profiling.count('pair_exchanges', n * (n - 1))
     pop = np.array([c.N for c in countries])
 
     prop = [[mig[t][i][j] / pop[i] for j in range(n)] for i in range(n)]
@@ -80,22 +86,44 @@ def migration(t, countries, mig):
             countries[i].R[t] += prop[j][i] * R[j]  # in migration
 
 
-def simulate(countries, mig, Horizon=horizon):
+@profiling.timed('simulate')
+def simulate(countries, mig, Horizon=horizon, start=1, method='euler', progress=None):
     """
     Method simulating the spread of a virus in an ensemble of countries following a Multi-Country SIR model.
+    The simulation itself is done by the array engine of engine.py, the resulting trajectories are then stored back in
+    the Country objects.
     :param countries: the list of Country objects representing the different countries on which the migrations are applied
     :param mig: the migration matrix containing the number of daily movers between each pair of country for each time step
     :param Horizon: the range period in terms of days for the simulation
+    :param start: the first time step to simulate, the previous ones are kept from the Country objects. After a
+    modification of the migration matrix from day t, simulating again from t gives the same result as from day 1.
+    :param method: 'euler' for the daily SIR step followed by the migration step, or 'rk4' or 'rk45' to integrate the
+    continuous-time model with integrators.py, interpolated on the daily grid
+    :param progress: if given, function called after each simulated time step t with t and the array of shape
+    (Horizon, 3, n) of the states, as in simulate_arrays. It is only used by the 'euler' method.
     :return: a list of the evolution of infected individuals in each country for every time step t
     """
-    for t in range(1, Horizon):
-        for c in countries:
-            c.simulate(t)
-        migration(t, countries, mig)
+    N = np.array([c.N for c in countries], dtype=float)
+    beta = np.array([c.beta[:Horizon] for c in countries], dtype=float).T
+    gamma = np.array([c.gamma for c in countries], dtype=float)
+    start = max(start, 1)
+    states = None
+    if start > 1:
+        states = np.array([[c.S[:Horizon], c.I[:Horizon], c.R[:Horizon]] for c in countries], dtype=float).transpose(2, 1, 0)
+    initial = [c.S[0] for c in countries], [c.I[0] for c in countries], [c.R[0] for c in countries]
+    if method == 'euler':
+        S, I, R = simulate_arrays(N, beta, gamma, mig, *initial, Horizon, start=start, states=states, progress=progress)
+    else:
+        S, I, R, nfev = integrate(N, beta, gamma, mig, *initial, Horizon, method=method, start=start, states=states)
+    for k, c in enumerate(countries):
+        c.S[start:Horizon] = S[start:, k].tolist()
+        c.I[start:Horizon] = I[start:, k].tolist()
+        c.R[start:Horizon] = R[start:, k].tolist()
     return [c.I.copy() for c in countries]
 
 
 
+@profiling.timed('create_countries')
 def create_countries(name_countries,origin='united kingdom',beta=0.2,gamma=0.1,I0=10,Horizon=horizon):
     """
     Function creating a list of Country object
@@ -108,6 +136,7 @@ def create_countries(name_countries,origin='united kingdom',beta=0.2,gamma=0.1,I
     :return: a list of Country object representing each country in the name_countries list
     """
     countries = []
+    profiling.count('population_lookups', len(name_countries))
     for country in name_countries:
         if country == origin:
             c = Country(name=country,N=df_countries['population'].loc[country],beta=beta,gamma=gamma,I0=I0,H=Horizon)
@@ -117,6 +146,46 @@ def create_countries(name_countries,origin='united kingdom',beta=0.2,gamma=0.1,I
     return countries
 
 
+def simulate_ensemble(name_countries, mig, origin='united kingdom', beta=0.2, gamma=0.1, I0=10, Horizon=horizon,
+                      summary=False, chunk_size=1024, stop_threshold=None, backend='numpy'):
+    """
+    Function simulating every combination of the given origin countries and parameters of the virus in one batched
+    pass of the engine, instead of one create_countries and simulate call per combination
+    :param name_countries: list of the names of each country
+    :param mig: the migration matrix shared by every scenario, of shape (Horizon, n, n), or one migration matrix per
+    scenario, of shape (number of scenarios, Horizon, n, n), in the order of scenario_grid, a ValueError being raised
+    if their number differs from the one of the scenarios
+    :param origin: country or list of countries of origin of the virus
+    :param beta: value or list of values of the contract rate of the virus
+    :param gamma: value or list of values of the recovery rate of the virus
+    :param I0: value or list of values of the number of infected individuals in the origin country at time step 0
+    :param Horizon: the range period in terms of days for the simulation
+    :param summary: if True, only the peak day, the peak value and the attack rate of each country are returned
+    :param chunk_size: the maximum number of scenarios simulated together
+    :param stop_threshold: if given, each scenario is stopped once the number of infected individuals is below this
+    threshold and decreasing in every country, the number of days simulated is returned under the key 'days' in summary
+    :param backend: 'numpy' for the array engine of engine.py or 'numba' for the compiled kernel of jit_engine.py, which
+    falls back to the array engine if Numba is not installed
+    :return: a dictionary with the parameters of each scenario and either the array of shape
+    (number of scenarios, Horizon, n) of infected individuals under the key 'I' or the summary statistics
+    """
+    origins = [origin] if isinstance(origin, str) else origin
+    origins, betas, gammas, I0s = scenario_grid([name_countries.index(c) for c in origins], beta, gamma, I0)
+    if not isinstance(mig, MigrationSchedule) and np.ndim(mig) == 4 and len(mig) != len(betas):
+        raise ValueError('mig holds {} migration matrices but the grid has {} scenarios, one matrix per scenario is '
+                         'needed, in the order of scenario_grid'.format(len(mig), len(betas)))
+    N = df_countries['population'].loc[name_countries].values.astype(float)
+    run = jit_engine.simulate_batch if backend == 'numba' else simulate_batch
+    res = run(N, betas, gammas, mig, initial_infected(len(name_countries), origins, I0s), Horizon,
+              chunk_size=chunk_size, summary=summary, stop_threshold=stop_threshold)
+    scenarios = {'origin': [name_countries[i] for i in origins], 'beta': betas, 'gamma': gammas, 'I0': I0s}
+    if summary:
+        scenarios.update(res)
+    else:
+        scenarios['I'] = res
+    return scenarios
+
+
 def modify_mig(country1,country2,countries,factor,mig,t=0):
     """
     Function modifying the value of daily movers between 2 countries for the period of time [t,Horizon]
@@ -124,7 +193,8 @@ def modify_mig(country1,country2,countries,factor,mig,t=0):
     :param country2: the second country of the pair of countries with the whose the migration flux will be modified
     :param countries: the list of Country object
     :param factor: the factor by which the number of daily movers will be multiply
-    :param mig: the migration matrix containing the number of daily movers between each pair of country for each time step
+    :param mig: the migration matrix containing the number of daily movers between each pair of country for each time step,
+    or a MigrationSchedule which is modified in place
     :param t: the time step from which he numbers of daily movers between the 2 countries will be modified
     :return: the modified migration matrix containing the number of daily movers between each pair of country for each time step
     """
@@ -143,8 +213,11 @@ def modify_mig(country1,country2,countries,factor,mig,t=0):
                     country2 = [countries.index(country2)]
                 for i in country1:
                     for j in country2:
-                        mig[t:,i,j] = mig[t,i,j] * factor
-                        mig[t:,j,i] = mig[t,j,i] * factor
+                        if isinstance(mig, MigrationSchedule):
+                            mig.scale(i, j, factor, t)
+                        else:
+                            mig[t:,i,j] = mig[t,i,j] * factor
+                            mig[t:,j,i] = mig[t,j,i] * factor
     return mig
 
 
@@ -0,0 +1,169 @@
+import io
+import json
+import threading
+import urllib.request
+from concurrent.futures import Future
+
+import numpy as np
+
+from cache import ResultCache, fingerprint
+from sweep import run_scenarios
+
+
+class Coalescer:
+    """
+    The class object merging identical concurrent computations : while a computation of a key is running, the other
+    requests of the same key wait for its result instead of computing it again
+    """
+    def __init__(self):
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, compute):
+        """
+        Method returning the result of compute(), or the one of the computation of the same key already running
+        """
+        with self._lock:
+            future = self._running.get(key)
+            owner = future is None
+            if owner:
+                future = self._running[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(compute())
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                del self._running[key]
+        return future.result()
+
+
+def parse_scenarios(body, countries, N, Horizon, max_scenarios=1024):
+    """
+    Function checking the scenarios of a request and converting the names of the countries into indexes
+    :param body: the decoded JSON body, with the key scenarios holding one scenario or a list of scenarios. A scenario
+    is a dictionary with the keys origin (name or index), beta, gamma and optionally I0 (10 by default) and edits, a
+    list of [country 1, country 2, factor, start day] multiplying the daily movers between the 2 countries (in both
+    directions) from the start day, as in modify_mig. A country of an edit can be 'all' for every country, each pair
+    of countries being edited once.
+    :param countries: the names of the countries, in the order of the simulation
+    :param N: total population of each country, of shape (n,), bounding I0 in the origin country
+    :param Horizon: the range period in terms of days for the simulation
+    :param max_scenarios: the maximum number of scenarios of a request
+    :return: the list of scenarios in the format of run_sweep
+    """
+    scenarios = body.get('scenarios')
+    if isinstance(scenarios, dict):
+        scenarios = [scenarios]
+    if not isinstance(scenarios, list) or not scenarios:
+        raise ValueError('scenarios must be a scenario or a non-empty list of scenarios')
+    if len(scenarios) > max_scenarios:
+        raise ValueError('at most {} scenarios can be simulated by a request, not {}'.format(max_scenarios,
+                                                                                            len(scenarios)))
+
+    def index(country):
+        # bool is a subclass of int, but true and false are not countries
+        if isinstance(country, int) and not isinstance(country, bool) and 0 <= country < len(countries):
+            return country
+        if isinstance(country, str) and country in countries:
+            return countries.index(country)
+        raise ValueError('unknown country {!r}'.format(country))
+
+    def pairs(country1, country2):
+        first = range(len(countries)) if country1 == 'all' else [index(country1)]
+        second = range(len(countries)) if country2 == 'all' else [index(country2)]
+        return sorted({(min(i, j), max(i, j)) for i in first for j in second if i != j})
+
+    parsed = []
+    for s in scenarios:
+        try:
+            if not isinstance(s, dict):
+                raise TypeError('a scenario must be a JSON object')
+            edits = tuple((i, j, float(factor), int(t)) for country1, country2, factor, t in s.get('edits', ())
+                          for i, j in pairs(country1, country2))
+            if any(t < 0 or t >= Horizon for i, j, factor, t in edits):
+                raise ValueError('the start days of the edits must be between 0 and {}'.format(Horizon - 1))
+            scenario = {'origin': index(s['origin']), 'beta': float(s['beta']), 'gamma': float(s['gamma']),
+                        'I0': float(s.get('I0', 10)), 'edits': edits}
+            # as in modify_mig, the factors must be non-negative, and so must be the rates and the infected individuals
+            values = [scenario['beta'], scenario['gamma'], scenario['I0']] + [factor for i, j, factor, t in edits]
+            if not all(np.isfinite(v) and v >= 0 for v in values):
+                raise ValueError('beta, gamma, I0 and the factors of the edits must be non-negative numbers')
+            if scenario['I0'] > N[scenario['origin']]:
+                raise ValueError('I0 is larger than the population {:g} of the origin'.format(N[scenario['origin']]))
+            parsed.append(scenario)
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError('invalid scenario {!r}: {}'.format(s, error))
+    return parsed
+
+
+def register_api(server, baseline, N, countries, Horizon, backend='numpy', cache_max_entries=32, max_scenarios=1024):
+    """
+    Function adding the simulation endpoint POST /api/simulate to a Flask server. The scenarios of a request are
+    simulated together by the batched engine, each one on its edited schedule, and the results are returned as a
+    compressed npz file holding the arrays of every scenario and the names of the countries, see request_simulation.
+    Identical concurrent requests are simulated once, and the responses of the last requests are cached.
+    The body of a request is a JSON object with the key scenarios (see parse_scenarios), and optionally output,
+    'summary' (default) for the peak day, peak value and attack rate of each country, or 'trajectories' for the
+    infected individuals of shape (scenarios, Horizon, n), and dtype, 'float64' (default) or 'float32'.
+    :param server: the Flask server, such as app.server of a Dash app
+    :param baseline: function returning the baseline MigrationSchedule, in daily movers
+    :param N: total population of each country, of shape (n,)
+    :param countries: the names of the countries, in the order of the simulation
+    :param Horizon: the range period in terms of days for the simulation
+    :param backend: 'numpy' for the array engine of engine.py or 'numba' for the compiled kernel of jit_engine.py
+    :param cache_max_entries: the number of responses cached
+    :param max_scenarios: the maximum number of scenarios of a request, larger requests being answered with a 400
+    """
+    from flask import request, Response, jsonify
+
+    N = np.asarray(N, dtype=float)
+    coalescer = Coalescer()
+    responses = ResultCache(max_entries=cache_max_entries)
+
+    def simulate(scenarios, output, dtype, schedule):
+        out = run_scenarios(schedule, N, scenarios, Horizon, summary=output == 'summary', backend=backend)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, countries=np.array(countries),
+                            **{k: v.astype(dtype) if v.dtype.kind == 'f' else v for k, v in out.items()})
+        return buffer.getvalue()
+
+    @server.route('/api/simulate', methods=['POST'])
+    def api_simulate():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify(error='the body must be a JSON object'), 400
+        output = body.get('output', 'summary')
+        dtype = body.get('dtype', 'float64')
+        if output not in ('summary', 'trajectories') or dtype not in ('float64', 'float32'):
+            return jsonify(error='output must be summary or trajectories and dtype float64 or float32'), 400
+        try:
+            scenarios = parse_scenarios(body, countries, N, Horizon, max_scenarios)
+        except ValueError as error:
+            return jsonify(error=str(error)), 400
+        schedule = baseline()
+        key = fingerprint(scenarios, output, dtype, schedule.digest())
+        data = responses.get_or_compute(key, lambda: coalescer.run(
+            key, lambda: simulate(scenarios, output, dtype, schedule)))
+        return Response(data, mimetype='application/octet-stream')
+
+
+def request_simulation(url, scenarios, output='summary', dtype='float64', timeout=600):
+    """
+    Function calling the simulation endpoint of register_api, for the clients which do not need to import the model
+    :param url: the url of the server, such as http://localhost:8050
+    :param scenarios: one scenario or a list of scenarios, see parse_scenarios
+    :param output: 'summary' or 'trajectories'
+    :param dtype: 'float64' or 'float32'
+    :param timeout: the timeout of the request in seconds
+    :return: the dictionary of the result arrays, whose first dimension is the scenario, and the names of the countries
+    under the key countries
+    """
+    body = json.dumps({'scenarios': scenarios, 'output': output, 'dtype': dtype}).encode()
+    req = urllib.request.Request(url.rstrip('/') + '/api/simulate', data=body,
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        with np.load(io.BytesIO(response.read())) as f:
+            return {name: f[name] for name in f.files}
@@ -0,0 +1,144 @@
+import numpy as np
+
+from engine import simulate_batch, initial_infected, peak_time
+import jit_engine
+from cache import ResultCache, fingerprint
+from schedule import MigrationSchedule
+from sweep import apply_edits
+
+
+def removed_movers(schedule, i, j, factor, t):
+    """
+    Function computing the cost of a ban : the number of daily movers between 2 countries removed by the edit
+    (i, j, factor, t) of apply_edits, summed over the days and both directions
+    :param schedule: the MigrationSchedule without the ban
+    :return: the number of movers removed
+    """
+    cost = 0.0
+    for a, b in ((i, j), (j, i)):
+        kept = schedule[t][a, b] * factor
+        for first, end, m in schedule.segments():
+            if end > t:
+                cost += (m[a, b] - kept) * (end - max(first, t))
+    return cost
+
+
+def optimize_bans(N, mig, origin, targets, beta=0.2, gamma=0.1, I0=10, Horizon=None, factors=(0.0,), start_days=(0,),
+                  corridors=None, width=64, prune=1e-3, max_bans=None, cache=None, chunk_size=256, backend='numpy'):
+    """
+    Function searching for a cheap set of travel bans delaying the peak of the virus in some countries by a given number
+    of days. The cost of a set of bans is the number of movers removed, see removed_movers.
+    The search is greedy : on each round, every candidate ban (a corridor not banned yet, a factor and a start day) is
+    added to the current set and the candidate sets are simulated together in one batch, then the ban with the largest
+    reduction of the missing delay is kept. Once the targets are met, the bans which are no longer needed are removed,
+    the most expensive first. The search is run twice, ranking the bans by their reduction of the missing delay per
+    mover removed then by the reduction itself, and the cheapest set of bans is returned.
+    The corridors whose ban alone has no effect on the peaks of the targets are pruned, and only the width best
+    candidates of the previous round are evaluated again. The simulated sets of bans are cached.
+    :param N: total population of each country, of shape (n,)
+    :param mig: the baseline MigrationSchedule, or migration matrix of shape (Horizon, n, n)
+    :param origin: the index of the origin country of the virus
+    :param targets: a dictionary giving for the index of each target country the minimum delay of its peak, in days
+    :param beta: contact rate of the virus
+    :param gamma: recovery rate of the virus
+    :param I0: number of infected individuals in the origin country at time step 0
+    :param Horizon: the range period in terms of days for the simulation, by default the one of mig
+    :param factors: the factors by which the daily movers of a banned corridor can be multiplied
+    :param start_days: the days from which the bans can be applied
+    :param corridors: the list of the pairs (i, j), i < j, which can be banned, by default every pair of countries
+    :param width: the number of best candidates of the previous round evaluated on each round, None for every
+    candidate
+    :param prune: the minimum effect in days of a ban on the peak of a target country to keep its corridor
+    :param max_bans: the maximum number of bans
+    :param cache: the ResultCache of the peak times of the sets of bans, shared between searches
+    :param chunk_size: the number of scenarios simulated together
+    :param backend: 'numpy' for engine.py or 'numba' for the compiled kernel of jit_engine.py
+    :return: a dictionary with the edits of the bans (tuples (i, j, factor, t) for apply_edits), their cost, the delay
+    of the peak of each target, whether the targets are met, and the number of simulated sets of bans
+    """
+    baseline = mig if isinstance(mig, MigrationSchedule) else MigrationSchedule.from_dense(mig)
+    Horizon = baseline.H if Horizon is None else Horizon
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    cache = ResultCache(max_entries=None) if cache is None else cache
+    run = jit_engine.simulate_batch if backend == 'numba' else simulate_batch
+    target = np.array(list(targets), dtype=int)
+    delay = np.array(list(targets.values()), dtype=float)
+    context = (origin, beta, gamma, I0, Horizon, baseline.digest(), tuple(target))
+    stats = {'simulated': 0}
+
+    def evaluate(sets):
+        # peak times of the targets for each set of bans, simulating only the sets not cached
+        keys = [fingerprint(context, tuple(sorted(s))) for s in sets]
+        found = {k: cache.get(k) for k in set(keys) if k in cache}
+        missing = [(k, s) for k, s in dict(zip(keys, sets)).items() if k not in found]
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            migs = [apply_edits(baseline, s) for k, s in chunk]
+            B = len(chunk)
+            I = run(N, np.full(B, beta), np.full(B, gamma), migs,
+                    initial_infected(n, np.full(B, origin), np.full(B, I0)), Horizon, chunk_size=chunk_size)
+            for (k, s), peaks in zip(chunk, peak_time(I[:, :, target])):
+                cache.put(k, peaks)
+                found[k] = peaks
+            stats['simulated'] += B
+        return np.array([found[k] for k in keys])
+
+    def shortfall(peaks):
+        return np.maximum(delay - (peaks - reference), 0.0).sum(axis=-1)
+
+    reference = evaluate([()])[0]
+    options = [(f, t) for f in factors for t in start_days if f < 1]
+    pool = [(i, j) for i in range(n) for j in range(i + 1, n)] if corridors is None else list(corridors)
+    costs = {(i, j, f, t): removed_movers(baseline, i, j, f, t) for i, j in pool for f, t in options}
+    costs = {c: v for c, v in costs.items() if v > 0}
+    # pruning of the corridors whose ban alone does not move the peaks of the targets
+    singles = list(costs)
+    effect = np.abs(evaluate([[c] for c in singles]) - reference).max(axis=-1)
+    useful = {c[:2] for c, e in zip(singles, effect) if e >= prune}
+    costs = {c: v for c, v in costs.items() if c[:2] in useful}
+
+    def greedy(per_cost):
+        # adds on each round the ban with the largest reduction of the missing delay, per mover removed or not
+        bans, missing, score = [], shortfall(reference), {}
+        lazy = False
+        while missing > 0 and (max_bans is None or len(bans) < max_bans):
+            banned = {(i, j) for i, j, f, t in bans}
+            candidates = [c for c in costs if c[:2] not in banned]
+            if lazy:
+                candidates = sorted(candidates, key=lambda c: -score[c])[:width]
+            if not candidates:
+                break
+            gain = missing - shortfall(evaluate([bans + [c] for c in candidates]))
+            round_score = {c: g / costs[c] if per_cost else g for c, g in zip(candidates, gain)}
+            score.update(round_score)
+            if max(round_score.values()) <= 0:
+                if lazy:
+                    # the best candidates of the previous round no longer help, every candidate is evaluated again
+                    lazy = False
+                    continue
+                break
+            lazy = width is not None
+            bans.append(max(round_score, key=round_score.get))
+            missing = shortfall(evaluate([bans])[0])
+
+        # removal of the bans which are no longer needed to meet the targets
+        while missing == 0 and len(bans) > 1:
+            reduced = [[b for b in bans if b != c] for c in bans]
+            ok = [c for c, m in zip(bans, shortfall(evaluate(reduced))) if m == 0]
+            if not ok:
+                break
+            bans.remove(max(ok, key=costs.get))
+        return bans, missing
+
+    best = None
+    for per_cost in (True, False):
+        bans, missing = greedy(per_cost)
+        cost = sum(costs[b] for b in bans)
+        if best is None or (missing, cost) < (best[1], best[2]):
+            best = bans, missing, cost
+    bans, missing, cost = best
+
+    peaks = evaluate([bans])[0]
+    return {'edits': bans, 'cost': cost, 'delay': dict(zip(target.tolist(), (peaks - reference).tolist())),
+            'feasible': bool(missing == 0), 'simulated': stats['simulated']}
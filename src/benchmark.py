@@ -0,0 +1,342 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+from engine import simulate_arrays, simulate_batch, initial_infected, migration_operator, apply_migration
+import jit_engine
+from schedule import MigrationSchedule
+
+# parameters identifying a benchmark, used to match the results with the ones of the baseline
+key_columns = ('benchmark', 'engine', 'nodes', 'horizon', 'batch', 'density')
+
+
+def random_network(n, density, seed=0):
+    """
+    Function creating a synthetic network of countries, so that the benchmarks do not depend on the data files
+    :param n: the number of countries
+    :param density: the fraction of the pairs of countries with daily movers
+    :param seed: the seed of the random generator
+    :return: the total population of each country, of shape (n,), and the migration matrix of shape (n, n)
+    """
+    rng = np.random.default_rng(seed)
+    N = rng.uniform(1e5, 1e8, n)
+    mig = rng.uniform(0, 1e-3, (n, n)) * np.minimum(N[:, None], N[None, :])
+    mig *= rng.random((n, n)) < density
+    mig = np.triu(mig, 1)
+    return N, mig + mig.T
+
+
+def make_case(n, Horizon, batch=1, density=1.0, seed=0):
+    """
+    Function creating the inputs of a benchmark : a synthetic network whose first corridor is banned from the middle
+    of the horizon, so that the migration changes once, and batch scenarios with different origins and contact rates
+    :return: a dictionary with the inputs, the migration being given as a dense array, a MigrationSchedule and a sparse
+    MigrationSchedule (None without SciPy)
+    """
+    N, mig = random_network(n, density, seed)
+    schedule = MigrationSchedule(mig, Horizon)
+    schedule.scale(0, 1, 0.0, Horizon // 2)
+    sparse = None
+    if sp is not None:
+        sparse = MigrationSchedule(sp.csr_matrix(mig), Horizon)
+        sparse.scale(0, 1, 0.0, Horizon // 2)
+    origin = np.arange(batch) % n
+    return {'N': N, 'dense': schedule.to_dense(), 'schedule': schedule, 'sparse': sparse, 'Horizon': Horizon,
+            'beta': np.linspace(0.15, 0.35, batch), 'gamma': np.full(batch, 0.1),
+            'I0': initial_infected(n, origin, np.full(batch, 10.0))}
+
+
+def reference_simulate(N, beta, gamma, mig, I0, Horizon):
+    """
+    Function simulating a scenario with plain Python loops over the countries and the pairs of countries, doing the
+    operations of Country.simulate then of the migration function of Country.py in the same order, used as the
+    reference of the engines. Unlike Country.py, it does not need the data files.
+    :return: the array of shape (Horizon, n) of infected individuals
+    """
+    n = len(N)
+    S = [[0.0] * n for t in range(Horizon)]
+    I = [[0.0] * n for t in range(Horizon)]
+    R = [[0.0] * n for t in range(Horizon)]
+    for i in range(n):
+        S[0][i], I[0][i], R[0][i] = N[i] - I0[i], I0[i], 0.0
+    for t in range(1, Horizon):
+        for i in range(n):
+            dS = -beta * S[t - 1][i] * I[t - 1][i] / N[i]
+            dI = beta * S[t - 1][i] * I[t - 1][i] / N[i] - gamma * I[t - 1][i]
+            dR = gamma * I[t - 1][i]
+            S[t][i], I[t][i], R[t][i] = S[t - 1][i] + dS, I[t - 1][i] + dI, R[t - 1][i] + dR
+        prop = [[mig[t][i][j] / N[i] for j in range(n)] for i in range(n)]
+        before = [list(X[t]) for X in (S, I, R)]
+        for X, Y in zip((S, I, R), before):
+            for i in range(n):
+                for j in range(n):
+                    X[t][i] -= prop[i][j] * Y[i]
+                    X[t][i] += prop[j][i] * Y[j]
+    return np.array(I)
+
+
+def country_simulate(N, beta, gamma, mig, I0, Horizon):
+    """
+    Function simulating a scenario with the original loop over the Country objects, the SIR step of each country then
+    the migration function on each day
+    :return: the array of shape (Horizon, n) of infected individuals
+    """
+    # imported here as Country loads the data files at its import, which the other engines do not need
+    from Country import Country, migration
+    countries = [Country(name=str(k), H=Horizon, N=N[k], beta=beta, gamma=gamma, I0=I0[k]) for k in range(len(N))]
+    for t in range(1, Horizon):
+        for c in countries:
+            c.simulate(t)
+        migration(t, countries, mig)
+    return np.array([c.I for c in countries]).T
+
+
+def _one_by_one(run):
+    # engine simulating a single scenario, called for each scenario of the batch
+    def engine(case):
+        return np.array([run(case, k) for k in range(case['I0'].shape[0])])
+    return engine
+
+
+def _arrays(mig):
+    def run(case, k):
+        N, I0 = case['N'], case['I0'][k]
+        return simulate_arrays(N, case['beta'][k], case['gamma'][k], case[mig], N - I0, I0, 0.0, case['Horizon'])[1]
+    return run
+
+
+engines = {
+    'country': _one_by_one(lambda case, k: country_simulate(case['N'], case['beta'][k], case['gamma'][k],
+                                                              case['dense'], case['I0'][k], case['Horizon'])),
+    'numpy': _one_by_one(_arrays('dense')),
+    'schedule': _one_by_one(_arrays('schedule')),
+    'sparse': _one_by_one(_arrays('sparse')),
+    'batch': lambda case: simulate_batch(case['N'], case['beta'], case['gamma'], case['schedule'], case['I0'],
+                                         case['Horizon']),
+    'numba': lambda case: jit_engine.simulate_batch(case['N'], case['beta'], case['gamma'], case['schedule'],
+                                                    case['I0'], case['Horizon']),
+}
+
+
+def available(engine):
+    """
+    Function telling if an engine can be run, its optional dependency being installed, or the data files for the
+    reference loop over the Country objects
+    """
+    if engine == 'country':
+        return _data_available()
+    if engine == 'sparse':
+        return sp is not None
+    if engine == 'numba':
+        return jit_engine.available()
+    return True
+
+
+def _data_available():
+    try:
+        import data
+    except OSError:
+        return False
+    return True
+
+
+def measure(function, repeat=3):
+    """
+    Function measuring a function : its best wall time over repeat calls after a first call (which compiles the
+    kernels of the JIT backend), then the peak of the memory allocated by Python and NumPy during one more call, traced
+    separately so that the tracing does not slow down the timed calls
+    :return: the wall time in seconds, the peak memory in bytes and the result of the function
+    """
+    result = function()
+    seconds = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def check_equivalence(n=12, Horizon=120, batch=4, density=0.5, rtol=1e-9, atol=1e-3):
+    """
+    Function checking every available engine, the loop over the Country objects included when the data files are
+    present, against reference_simulate on synthetic scenarios with different origins and contact rates and a migration
+    changing during the horizon
+    :param rtol: the relative tolerance on the infected individuals
+    :param atol: the absolute tolerance on the infected individuals
+    :return: a list with for each engine its maximum absolute and relative errors and whether it is within tolerance
+    """
+    case = make_case(n, Horizon, batch, density)
+    reference = _one_by_one(lambda case, k: reference_simulate(case['N'], case['beta'][k], case['gamma'][k],
+                                                               case['dense'], case['I0'][k], case['Horizon']))(case)
+    report = []
+    for engine in engines:
+        if not available(engine):
+            continue
+        I = np.asarray(engines[engine](case))
+        error = np.abs(I - reference)
+        report.append({'engine': engine, 'max_abs_error': float(error.max()),
+                       'max_rel_error': float((error / np.maximum(np.abs(reference), atol)).max()),
+                       'ok': bool(np.allclose(I, reference, rtol=rtol, atol=atol))})
+    return report
+
+
+def benchmark_cases(quick=False):
+    """
+    Function listing the benchmarks of the simulation core : the engines by number of countries, horizon and density of
+    the migration, the batched engines by number of scenarios, the migration step alone, and the creation of the
+    migration matrix from the data files
+    :param quick: if True, a smaller grid for a fast check
+    :return: the list of the dictionaries of parameters of the benchmarks
+    """
+    nodes, horizons, batches = ((10, 30), (100,), (1, 64)) if quick else ((10, 30, 100, 300), (100, 350),
+                                                                          (1, 16, 128, 1024))
+    cases = []
+    for n in nodes:
+        for Horizon in horizons:
+            for density in (0.1, 1.0):
+                for engine in engines:
+                    # the reference loop is quadratic in the number of countries in Python
+                    if engine != 'country' or n * n * Horizon <= 4e5:
+                        cases.append({'benchmark': 'engine', 'engine': engine, 'nodes': n, 'horizon': Horizon,
+                                      'batch': 1, 'density': density})
+    for batch in batches:
+        for engine in ('numpy', 'batch', 'numba'):
+            cases.append({'benchmark': 'batch', 'engine': engine, 'nodes': 30, 'horizon': horizons[-1],
+                          'batch': batch, 'density': 1.0})
+    for n in nodes:
+        for engine in ('country', 'numpy'):
+            if engine != 'country' or n <= 100:
+                cases.append({'benchmark': 'migration', 'engine': engine, 'nodes': n, 'horizon': horizons[-1],
+                              'batch': 1, 'density': 1.0})
+    for Horizon in horizons:
+        for engine in ('dense', 'schedule'):
+            cases.append({'benchmark': 'migration_matrix', 'engine': engine, 'nodes': None, 'horizon': Horizon,
+                          'batch': 1, 'density': None})
+    return cases
+
+
+def _migration_steps(case, engine):
+    # the migration step alone on every day, applied to the initial states
+    N, mig, Horizon = case['N'], case['dense'], case['Horizon']
+    if engine == 'country':
+        from Country import Country, migration
+        countries = [Country(name=str(k), H=Horizon, N=N[k], I0=case['I0'][0, k]) for k in range(len(N))]
+        return lambda: [migration(t, countries, mig) for t in range(1, Horizon)]
+    X = np.stack([N - case['I0'][0], case['I0'][0], np.zeros(len(N))])
+    return lambda: [apply_migration(migration_operator(mig[t], N), X) for t in range(1, Horizon)]
+
+
+def run_case(params, repeat=3):
+    """
+    Function running a benchmark
+    :param params: the dictionary of parameters of the benchmark, see benchmark_cases
+    :param repeat: the number of timed calls
+    :return: the parameters completed with the wall time in seconds, the peak memory in bytes and the number of
+    simulated days times countries (times scenarios) per second, or None if its engine or the data files are not
+    available
+    """
+    benchmark, engine = params['benchmark'], params['engine']
+    if benchmark == 'migration_matrix':
+        if not _data_available():
+            return None
+        import data
+        function = (lambda: data.create_migration_matrix(params['horizon'])) if engine == 'dense' \
+            else (lambda: data.create_migration_schedule(params['horizon']))
+        work = params['horizon'] * len(data.eu_countries)
+    else:
+        if not available(engine):
+            return None
+        case = make_case(params['nodes'], params['horizon'], params['batch'], params['density'])
+        function = _migration_steps(case, engine) if benchmark == 'migration' else (lambda: engines[engine](case))
+        work = params['horizon'] * params['nodes'] * params['batch']
+    seconds, peak, result = measure(function, repeat)
+    return dict(params, seconds=seconds, peak_bytes=peak, node_days_per_second=work / seconds)
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=1e-3):
+    """
+    Function comparing the results of the benchmarks with the ones of a baseline run
+    :param results: the list of results of run_case
+    :param baseline: the list of results of the baseline run
+    :param tolerance: the relative increase of the wall time or of the peak memory flagged as a regression
+    :param min_seconds: the increase of the wall time under which the difference is considered as noise
+    :return: the list of the regressions, with the parameters, the metric, the baseline and the new values
+    """
+    reference = {tuple(r.get(c) for c in key_columns): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = reference.get(tuple(r.get(c) for c in key_columns))
+        if old is None:
+            continue
+        slower = r['seconds'] > old['seconds'] * (1 + tolerance) and r['seconds'] - old['seconds'] > min_seconds
+        larger = r['peak_bytes'] > old['peak_bytes'] * (1 + tolerance) and r['peak_bytes'] - old['peak_bytes'] > 2 ** 20
+        for metric, flagged in (('seconds', slower), ('peak_bytes', larger)):
+            if flagged:
+                regressions.append(dict({c: r.get(c) for c in key_columns}, metric=metric, baseline=old[metric],
+                                        value=r[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks and equivalence checks of the simulation engines')
+    parser.add_argument('--quick', action='store_true', help='run a smaller grid of benchmarks')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed calls of each benchmark')
+    parser.add_argument('--only', help='run only the benchmarks of this name (engine, batch, migration, '
+                                       'migration_matrix)')
+    parser.add_argument('--output', help='file of the JSON report, printed if not given')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown flagged as a regression')
+    parser.add_argument('--skip-equivalence', action='store_true', help='do not check the engines against the '
+                                                                         'reference')
+    args = parser.parse_args(argv)
+
+    equivalence = [] if args.skip_equivalence else check_equivalence()
+    results = []
+    for params in benchmark_cases(args.quick):
+        if args.only is None or params['benchmark'] == args.only:
+            result = run_case(params, args.repeat)
+            if result is not None:
+                results.append(result)
+                print('{benchmark:<16} {engine:<9} n={nodes} H={horizon} B={batch} density={density}: '
+                      '{seconds:.4f} s'.format(**result), file=sys.stderr)
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+    report = {'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                          'processor': platform.processor() or platform.machine(),
+                          'numba': jit_engine.available(), 'scipy': sp is not None},
+              'equivalence': equivalence, 'results': results, 'regressions': regressions}
+    if args.output is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    for r in equivalence:
+        if not r['ok']:
+            print('engine {engine} differs from the reference: max abs error {max_abs_error:.3g}'.format(**r),
+                  file=sys.stderr)
+    for r in regressions:
+        print('regression of {benchmark} {engine} n={nodes} H={horizon} B={batch}: {metric} {baseline:.4g} -> '
+              '{value:.4g}'.format(**r), file=sys.stderr)
+    return 1 if regressions or not all(r['ok'] for r in equivalence) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import profiling
+
+
+def fingerprint(*parts):
+    """
+    Function computing a short content hash of the inputs of a simulation (parameters, digest of the migration
+    schedule, ...), used as the key of the cached results
+    :param parts: the values to hash, their repr must identify them
+    :return: the hexadecimal digest
+    """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def array_digest(array):
+    """
+    Function computing a content hash of a NumPy array or of a SciPy sparse matrix
+    :param array: the array to hash
+    :return: the hexadecimal digest
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if hasattr(array, 'indptr'):
+        array = array.tocsr()
+        for a in (array.data, array.indices, array.indptr):
+            h.update(np.ascontiguousarray(a).tobytes())
+        h.update(repr(array.shape).encode())
+    else:
+        array = np.ascontiguousarray(array)
+        # hashed through the buffer of the array, without a copy of a memory-mapped array in memory
+        h.update(array)
+        h.update(repr((array.shape, array.dtype.str)).encode())
+    return h.hexdigest()
+
+
+def sizeof(value):
+    """
+    Function estimating the memory used by a cached value, counting the buffers of the NumPy arrays
+    :param value: the value, possibly nested dictionaries, lists and tuples
+    :return: the estimated size in bytes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    if hasattr(value, 'to_plotly_json'):
+        return sizeof(value.to_plotly_json())
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+    The class object representing a bounded LRU cache of simulation results. The least recently used entries are
+    evicted once the number of entries or the estimated memory of the entries exceeds its limit.
+    """
+    def __init__(self, max_entries=64, max_bytes=None):
+        """
+        Construction method
+        :param max_entries: maximum number of entries kept, None for no limit
+        :param max_bytes: maximum estimated memory in bytes of the entries kept, None for no limit
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Method returning the value cached under key and marking it as the most recently used
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                profiling.count('cache_misses')
+                return default
+            self.hits += 1
+            profiling.count('cache_hits')
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes=None):
+        """
+        Method caching value under key, then evicting the least recently used entries if a limit is exceeded
+        :param key: the key, typically a fingerprint
+        :param value: the value to cache
+        :param nbytes: the memory used by the value, estimated with sizeof if not given
+        """
+        nbytes = sizeof(value) if nbytes is None else nbytes
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while len(self._entries) > 1 and ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                                              or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def pop(self, key, default=None):
+        """
+        Method removing the value cached under key and returning it, so that a mutable value (such as Country objects
+        used as checkpoint) is used by a single thread at a time
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value, nbytes = self._entries.pop(key)
+            self.nbytes -= nbytes
+            return value
+
+    def get_or_compute(self, key, compute):
+        """
+        Method returning the value cached under key, computing it with compute() and caching it if it is missing, its
+        memory being estimated with sizeof
+        """
+        value = self.get(key, None)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
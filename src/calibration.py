@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+from engine import operator_schedule, apply_migration, issparse
+
+
+def observed(countries, start, Horizon, column='new_cases_smoothed'):
+    """
+    Function extracting a daily series of the OWID data for each country, aligned on the time steps of a simulation
+    :param countries: the names of the countries, in the order of the simulation
+    :param start: the date of time step 0, as 'YYYY-MM-DD'
+    :param Horizon: the number of time steps
+    :param column: the column of df_owid to extract, such as new_cases_smoothed or reproduction_rate
+    :return: the array of shape (Horizon, n), NaN for the days without data
+    """
+    from data import df_owid
+
+    dates = pd.date_range(start, periods=Horizon).strftime('%Y-%m-%d')
+    table = df_owid.pivot_table(index='date', columns='location', values=column)
+    return table.reindex(index=dates, columns=countries).values.astype(float)
+
+
+def _expand(theta, Horizon, window):
+    # beta of each time step from the log of the contact rate of each window of days, of shape (B, Horizon, n)
+    return np.exp(np.repeat(theta, window, axis=1)[:, :Horizon])
+
+
+def loss_and_gradient(theta, N, gamma, mig, S0, I0, R0, cases, Horizon, window=7, smoothing=1.0):
+    """
+    Function computing the misfit between the daily new cases of a batch of candidate contact rates and the observed
+    ones, and its gradient with respect to the parameters by the adjoint method : one forward simulation and one
+    backward pass through the transposed steps, instead of one simulation per parameter for finite differences.
+    The new cases of time step t are the infections of the local SIR step, beta[t] * S[t - 1] * I[t - 1] / N. The
+    misfit is the mean squared difference of their logarithms (plus one) over the observed days, plus a penalty on the
+    variations of the log contact rate between consecutive windows.
+    :param theta: the log of the contact rate of each candidate, window of days and country, of shape (B, K, n), with
+    K * window >= Horizon
+    :param N: total population of each country, of shape (n,)
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule
+    :param S0: number of suspected individuals in each country at time step 0, of shape (n,)
+    :param I0: number of infected individuals in each country at time step 0, of shape (n,)
+    :param R0: number of recovered individuals in each country at time step 0, of shape (n,)
+    :param cases: the observed daily new cases of shape (Horizon, n), NaN for the days without data
+    :param Horizon: the range period in terms of days for the simulation
+    :param window: the number of days during which the contact rate is constant
+    :param smoothing: the weight of the penalty on the variations of the contact rate
+    :return: the losses of shape (B,) and their gradients of shape (B, K, n)
+    """
+    N = np.asarray(N, dtype=float)
+    gamma = np.asarray(gamma, dtype=float)
+    B, K, n = theta.shape
+    beta = _expand(theta, Horizon, window)
+    op, day = operator_schedule(mig, N, Horizon)
+    if issparse(op[0]):
+        op_t = [o.T.tocsr() for o in op]
+    else:
+        op_t = np.swapaxes(op, -1, -2)
+    mask = ~np.isnan(cases)
+    mask[0] = False
+    target = np.log1p(np.where(mask, cases, 0.0))
+    weight = mask / max(mask.sum(), 1)
+
+    X = np.zeros((Horizon, B, 3, n))
+    X[0, :, 0], X[0, :, 1], X[0, :, 2] = S0, I0, R0
+    new_cases = np.zeros((Horizon, B, n))
+    for t in range(1, Horizon):
+        S, I, R = X[t - 1, :, 0], X[t - 1, :, 1], X[t - 1, :, 2]
+        new_cases[t] = beta[:, t] * S * I / N
+        Y = np.stack([S - new_cases[t], I + new_cases[t] - gamma * I, R + gamma * I], axis=1)
+        X[t] = apply_migration(op[day[t]], Y)
+
+    error = np.log1p(np.maximum(new_cases, 0.0)) - target[:, None]
+    loss = (weight[:, None] * error ** 2).sum(axis=(0, 2))
+    d_cases = 2 * weight[:, None] * error / (1 + np.maximum(new_cases, 0.0))
+
+    # backward pass : lam is the derivative of the loss with respect to the state of time step t
+    lam = np.zeros((B, 3, n))
+    d_beta = np.zeros((B, Horizon, n))
+    for t in range(Horizon - 1, 0, -1):
+        mu = apply_migration(op_t[day[t]], lam)
+        S, I = X[t - 1, :, 0], X[t - 1, :, 1]
+        b = beta[:, t]
+        g = mu[:, 1] - mu[:, 0] + d_cases[t]
+        d_beta[:, t] = g * S * I / N
+        lam = np.stack([mu[:, 0] + g * b * I / N,
+                        mu[:, 1] + g * b * S / N + gamma * (mu[:, 2] - mu[:, 1]),
+                        mu[:, 2]], axis=1)
+
+    d_theta = np.zeros((B, K * window, n))
+    d_theta[:, :Horizon] = d_beta * beta
+    gradient = d_theta.reshape(B, K, window, n).sum(axis=2)
+    diff = np.diff(theta, axis=1)
+    loss = loss + smoothing * (diff ** 2).sum(axis=(1, 2)) / n
+    gradient[:, 1:] += 2 * smoothing * diff / n
+    gradient[:, :-1] -= 2 * smoothing * diff / n
+    return loss, gradient
+
+
+def calibrate(N, gamma, mig, cases, Horizon, I0=None, beta0=0.2, window=7, smoothing=1.0, candidates=8, spread=0.3,
+              seed=0, bounds=(1e-3, 5.0), maxiter=500):
+    """
+    Function fitting a time-varying contact rate for each country to the observed daily new cases. A batch of candidate
+    parameter sets, perturbations of beta0, is simulated and optimized together : the losses of the candidates are
+    independent, so their sum is minimized by L-BFGS-B with the gradients of loss_and_gradient, and the best candidate
+    is returned.
+    :param N: total population of each country, of shape (n,)
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule
+    :param cases: the observed daily new cases of shape (Horizon, n), NaN for the days without data, see observed
+    :param Horizon: the range period in terms of days for the simulation
+    :param I0: number of infected individuals in each country at time step 0, by default estimated from the first
+    observed new cases as cases / gamma
+    :param beta0: the initial contact rate, scalar or of shape (n,) or (Horizon, n), for instance the reproduction rate
+    multiplied by gamma
+    :param window: the number of days during which the contact rate is constant
+    :param smoothing: the weight of the penalty on the variations of the contact rate
+    :param candidates: the number of candidate parameter sets
+    :param spread: the standard deviation of the perturbations of the log of beta0 of the candidates
+    :param seed: the seed of the perturbations
+    :param bounds: the minimum and maximum contact rate
+    :param maxiter: the maximum number of iterations of L-BFGS-B
+    :return: the contact rates of shape (Horizon, n) of the best candidate, which can be used as the beta of Country
+    objects, and its loss
+    """
+    from scipy.optimize import minimize
+
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    gamma = np.asarray(gamma, dtype=float)
+    if I0 is None:
+        first = pd.DataFrame(cases).bfill().values[0]
+        I0 = np.maximum(np.nan_to_num(first) / np.broadcast_to(gamma, (n,)), 1.0)
+    I0 = np.asarray(I0, dtype=float)
+    R0 = np.zeros(n)
+    S0 = N - I0 - R0
+
+    K = -(-Horizon // window)
+    beta0 = np.broadcast_to(np.asarray(beta0, dtype=float), (Horizon, n)) if np.ndim(beta0) < 2 \
+        else np.asarray(beta0, dtype=float)
+    theta0 = np.full((K * window, n), np.nan)
+    theta0[:Horizon] = np.log(np.clip(beta0, *bounds))
+    theta0 = np.nanmean(theta0.reshape(K, window, n), axis=1)
+    rng = np.random.default_rng(seed)
+    theta0 = theta0[None] + spread * rng.standard_normal((candidates, K, n))
+    theta0[0] = theta0.mean(axis=0)
+
+    def objective(x):
+        loss, gradient = loss_and_gradient(x.reshape(candidates, K, n), N, gamma, mig, S0, I0, R0, cases, Horizon,
+                                           window, smoothing)
+        return loss.sum(), gradient.ravel()
+
+    result = minimize(objective, theta0.ravel(), jac=True, method='L-BFGS-B',
+                      bounds=[tuple(np.log(bounds))] * theta0.size, options={'maxiter': maxiter})
+    theta = result.x.reshape(candidates, K, n)
+    loss, _ = loss_and_gradient(theta, N, gamma, mig, S0, I0, R0, cases, Horizon, window, smoothing)
+    best = int(np.argmin(loss))
+    return _expand(theta[best:best + 1], Horizon, window)[0], loss[best]
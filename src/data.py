@@ -1,6 +1,12 @@
+import hashlib
+import json
+import os
+
 import numpy as np
 import pandas as pd
 
+from schedule import MigrationSchedule
+
 
 europe_countries = ['austria', 'belgium', 'bosnia and herzegovina', 'bulgaria', 'croatia',
        'czechia', 'denmark', 'estonia', 'finland', 'france', 'germany',
@@ -9,56 +15,176 @@ europe_countries = ['austria', 'belgium', 'bosnia and herzegovina', 'bulgaria',
        'serbia', 'slovakia', 'slovenia', 'spain', 'sweden', 'switzerland',
        'united kingdom']
 
-#csv file containing daily data about the covid-19 (new deaths and cases) in every country
-df_owid = pd.read_csv('../data/owid.csv')
-df_owid['location'] = df_owid['location'].str.lower()
+# ---------------- data --------------
 
+horizon = 350
 
+eu_countries = ['austria', 'belgium', 'bosnia and herzegovina', 'bulgaria', 'croatia' ,'czechia' ,'denmark',
+ 'estonia' ,'finland' ,'france' ,'germany', 'greece', 'hungary', 'iceland', 'ireland',
+ 'italy','lithuania' ,'luxembourg', 'netherlands', 'norway', 'poland', 'portugal',
+ 'romania', 'serbia', 'slovakia', 'slovenia', 'spain', 'sweden', 'switzerland', 'united kingdom']
 
-df_owid.replace({"location": {"czech republic":"czechia"}})
 
+order_countries = ['iceland','finland','sweden','norway','united kingdom','ireland','denmark','estonia','lithuania',
+                   'netherlands','germany','belgium','france','luxembourg','poland','czechia','slovakia','hungary',
+                   'switzerland','austria','italy','spain','portugal','slovenia','croatia',
+                   'serbia','bosnia and herzegovina','romania','bulgaria','greece']
 
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+# binary cache of the structures derived from the csv files, rebuilt when the hash of one of the files changes
+cache_dir = os.path.join(data_dir, 'cache')
+source_files = {'owid': 'owid.csv', 'countries': 'countries.csv', 'migration': 'migration_matrix.csv'}
 
-countries = sorted(df_owid.location.unique())
 
-df_owid = df_owid[['date','location','iso_code','new_cases_smoothed_per_million',
-                   'continent','population',
-                   'new_cases_smoothed','reproduction_rate','stringency_index']]
+def load_owid():
+    """
+    Function loading the csv file containing daily data about the covid-19 (new deaths and cases) in every european
+    country. It is only parsed when needed, see the lazy attributes df_owid, pop and countries of this module.
+    :return: the list of the locations of the whole file and the DataFrame of the european countries
+    """
+    #csv file containing daily data about the covid-19 (new deaths and cases) in every country
+    df_owid = pd.read_csv(os.path.join(data_dir, 'owid.csv'))
+    df_owid['location'] = df_owid['location'].str.lower()
 
-df_owid = df_owid[df_owid['location'].isin(europe_countries)]
 
 
-pop = df_owid.groupby(['location','iso_code']).agg({'population':'max'}).reset_index()#.set_index('location')
+    df_owid.replace({"location": {"czech republic":"czechia"}})
 
-#csv file containing information about the location (longitude, latitude) of countries
-df_countries = pd.read_csv('../data/countries.csv')
 
-# filter eu countries
-df_countries['Country'] = df_countries['Country'].str.lower()
-df_countries = df_countries[df_countries['Country'].isin(europe_countries)]
-latitude = df_countries.set_index(['Country']).to_dict(orient='dict')['Latitude']
-longitude = df_countries.set_index(['Country']).to_dict(orient='dict')['Longitude']
 
-df_countries = pd.merge(pop, df_countries, how='left', left_on='location', right_on='Country').drop(columns=['location']).set_index('Country')
-df_countries['Country'] = df_countries.index
+    countries = sorted(df_owid.location.unique())
 
+    df_owid = df_owid[['date','location','iso_code','new_cases_smoothed_per_million',
+                       'continent','population',
+                       'new_cases_smoothed','reproduction_rate','stringency_index']]
 
-# ---------------- data --------------
+    df_owid = df_owid[df_owid['location'].isin(europe_countries)]
+    return countries, df_owid
 
-horizon = 350
 
-eu_countries = ['austria', 'belgium', 'bosnia and herzegovina', 'bulgaria', 'croatia' ,'czechia' ,'denmark',
- 'estonia' ,'finland' ,'france' ,'germany', 'greece', 'hungary', 'iceland', 'ireland',
- 'italy','lithuania' ,'luxembourg', 'netherlands', 'norway', 'poland', 'portugal',
- 'romania', 'serbia', 'slovakia', 'slovenia', 'spain', 'sweden', 'switzerland', 'united kingdom']
+def _build_derived():
+    """
+    Function parsing the csv files and creating the structures needed for the experiments
+    :return: a dictionary of arrays and a dictionary of metadata (names and codes of the countries)
+    """
+    countries, df_owid = load_owid()
 
+    pop = df_owid.groupby(['location','iso_code']).agg({'population':'max'}).reset_index()#.set_index('location')
 
-order_countries = ['iceland','finland','sweden','norway','united kingdom','ireland','denmark','estonia','lithuania',
-                   'netherlands','germany','belgium','france','luxembourg','poland','czechia','slovakia','hungary',
-                   'switzerland','austria','italy','spain','portugal','slovenia','croatia',
-                   'serbia','bosnia and herzegovina','romania','bulgaria','greece']
+    #csv file containing information about the location (longitude, latitude) of countries
+    df_countries = pd.read_csv(os.path.join(data_dir, 'countries.csv'))
+
+    # filter eu countries
+    df_countries['Country'] = df_countries['Country'].str.lower()
+    df_countries = df_countries[df_countries['Country'].isin(europe_countries)]
+
+    df_countries = pd.merge(pop, df_countries, how='left', left_on='location', right_on='Country').drop(columns=['location']).set_index('Country')
+
+    migration_matrix_df = pd.read_csv(os.path.join(data_dir, 'migration_matrix.csv'), index_col='start_name')
+
+    arrays = {'population': df_countries['population'].values.astype(float),
+              'latitude': df_countries['Latitude'].values.astype(float),
+              'longitude': df_countries['Longitude'].values.astype(float),
+              'migration': migration_matrix_df.values.astype(float)}
+    metadata = {'countries': list(df_countries.index), 'iso_code': list(df_countries['iso_code']),
+                'iso2': list(df_countries['ISO 3166 Country Code']),
+                'migration_rows': list(migration_matrix_df.index), 'migration_columns': list(migration_matrix_df.columns)}
+    return arrays, metadata
+
+
+def _file_hash(path):
+    # sha256 of the content of a file, read by blocks
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
 
-migration_matrix_df = pd.read_csv('../data/migration_matrix.csv', index_col='start_name')
+
+def _source_state(previous):
+    """
+    Function computing the state (size, modification time and hash) of the source csv files. The hash is only
+    recomputed for the files whose size or modification time changed since the previous state.
+    :param previous: the state stored in the index of the cache, or an empty dictionary
+    :return: the dictionary of the state of each file, None for a missing file
+    """
+    state = {}
+    for name, file in source_files.items():
+        path = os.path.join(data_dir, file)
+        if not os.path.exists(path):
+            state[name] = None
+            continue
+        stat = os.stat(path)
+        old = previous.get(name)
+        if old is not None and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns:
+            digest = old['sha256']
+        else:
+            digest = _file_hash(path)
+        state[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+    return state
+
+
+def _write_cache(arrays, metadata, state, names=None):
+    """
+    Function writing the binary cache, each file being written under a temporary name then renamed, the index last, so
+    that a process importing the module concurrently never reads a partially written cache
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    for key, value in arrays.items():
+        tmp = os.path.join(cache_dir, key + '.tmp.npy')
+        np.save(tmp, value)
+        os.replace(tmp, os.path.join(cache_dir, key + '.npy'))
+    tmp = os.path.join(cache_dir, 'index.tmp.json')
+    with open(tmp, 'w') as f:
+        json.dump({'sources': state, 'arrays': list(arrays) if names is None else names, 'metadata': metadata}, f)
+    os.replace(tmp, os.path.join(cache_dir, 'index.json'))
+
+
+def load_derived():
+    """
+    Function loading the structures derived from the csv files from the binary cache, memory-mapping the arrays. The
+    cache is rebuilt when the hash of one of the source files differs from the one stored in its index. A missing
+    source file does not invalidate the cache, so that it can be deployed without the large owid.csv file.
+    :return: a dictionary of arrays and a dictionary of metadata (names and codes of the countries)
+    """
+    index_path = os.path.join(cache_dir, 'index.json')
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    state = _source_state(index['sources'] if index is not None else {})
+    if index is not None and all(state[name] is None
+                                 or state[name]['sha256'] == (index['sources'].get(name) or {}).get('sha256')
+                                 for name in source_files):
+        arrays = {key: np.load(os.path.join(cache_dir, key + '.npy'), mmap_mode='r') for key in index['arrays']}
+        state = {name: state[name] or index['sources'].get(name) for name in source_files}
+        if state != index['sources']:
+            # a file was touched without being modified, the new modification times avoid hashing it again
+            try:
+                _write_cache({}, index['metadata'], state, index['arrays'])
+            except OSError:
+                pass
+        return arrays, index['metadata']
+    arrays, metadata = _build_derived()
+    try:
+        _write_cache(arrays, metadata, state)
+    except OSError:
+        pass
+    return arrays, metadata
+
+
+_arrays, _metadata = load_derived()
+
+df_countries = pd.DataFrame({'iso_code': _metadata['iso_code'], 'population': np.array(_arrays['population']),
+                             'ISO 3166 Country Code': _metadata['iso2'], 'Latitude': np.array(_arrays['latitude']),
+                             'Longitude': np.array(_arrays['longitude'])},
+                            index=pd.Index(_metadata['countries'], name='Country'))
+df_countries['Country'] = df_countries.index
+latitude = df_countries['Latitude'].to_dict()
+longitude = df_countries['Longitude'].to_dict()
+
+migration_matrix_df = pd.DataFrame(np.array(_arrays['migration']), columns=_metadata['migration_columns'],
+                                   index=pd.Index(_metadata['migration_rows'], name='start_name'))
 
 migration_matrix_baseline = migration_matrix_df.copy()
 
@@ -70,6 +196,16 @@ migration_matrix_short = migration_matrix_short.apply(round)
 migration_matrix_short = migration_matrix_short.reset_index().rename(columns={'start_name':''})
 migration_matrix_short[''] = migration_matrix_short[''].apply(to_code)
 
+
+def __getattr__(name):
+    # the daily covid-19 data is only parsed when one of these attributes is accessed
+    if name in ('df_owid', 'pop', 'countries'):
+        countries, df_owid = load_owid()
+        pop = df_owid.groupby(['location','iso_code']).agg({'population':'max'}).reset_index()
+        globals().update(df_owid=df_owid, pop=pop, countries=countries)
+        return globals()[name]
+    raise AttributeError("module 'data' has no attribute '{}'".format(name))
+
 def create_migration_matrix(Horizon=350):
     """
     Function creating the 3 dimensional migration matrix containing the number of daily movers between each pair of
@@ -79,3 +215,58 @@ def create_migration_matrix(Horizon=350):
     The shape of the matrix is (Horizon,len(europe_countries),len(europe_countries)).
     """
     return np.array([migration_matrix_short.values[:,1:] for i in range(Horizon)])
+
+
+def create_migration_schedule(Horizon=350):
+    """
+    Function creating the migration schedule containing the number of daily movers between each pair of european country
+    for each time step. Unlike create_migration_matrix, the baseline matrix is stored only once.
+    :param Horizon: the range of time period in terms of days for the simulation
+    :return: the MigrationSchedule object with a single segment containing the baseline migration matrix
+    """
+    return MigrationSchedule(migration_matrix_short.values[:,1:].astype(float), Horizon)
+
+
+def read_migration_edges(path, nodes=None, origin='start_name', destination='end_name', value='traffic'):
+    """
+    Function reading a migration graph stored as a list of edges, such as the mobility between sub-national regions,
+    into a sparse matrix whose size grows with the number of edges and not with the square of the number of nodes
+    :param path: the path of the csv file with one row per pair of nodes with daily movers
+    :param nodes: the list of the names of the nodes, in the order of the matrix, by default every node of the file
+    sorted by name
+    :param origin: the column containing the name of the origin node
+    :param destination: the column containing the name of the destination node
+    :param value: the column containing the number of daily movers
+    :return: the list of the names of the nodes and the migration matrix in CSR format
+    """
+    import scipy.sparse as sp
+
+    edges = pd.read_csv(path, usecols=[origin, destination, value])
+    if nodes is None:
+        nodes = sorted(set(edges[origin]) | set(edges[destination]))
+    index = pd.Series(range(len(nodes)), index=nodes)
+    edges = edges[edges[origin].isin(index.index) & edges[destination].isin(index.index)]
+    mig = sp.csr_matrix((edges[value].values.astype(float),
+                         (index[edges[origin]].values, index[edges[destination]].values)),
+                        shape=(len(nodes), len(nodes)))
+    return nodes, mig
+
+
+def load_daily_migration(path, start=None, end=None):
+    """
+    Function loading the daily migration matrices created by build_daily_migration of migration_matrix.py. The file is
+    memory-mapped and not read : the returned array can be given to the simulation functions as the migration matrix,
+    and only the days used by the simulations are read from the disk, the pages being shared between processes.
+    :param path: the path of the .npy file
+    :param start: the first day to keep, as 'YYYY-MM-DD', by default the first day of the file
+    :param end: the last day to keep, as 'YYYY-MM-DD', by default the last day of the file
+    :return: the list of the dates, the list of the countries in the order of the matrices, and the read-only array of
+    shape (days, n, n) of the number of daily movers between each pair of country
+    """
+    with open(os.path.splitext(path)[0] + '.json') as f:
+        index = json.load(f)
+    dates = index['dates']
+    first = 0 if start is None else int(np.searchsorted(dates, start, side='left'))
+    last = len(dates) if end is None else int(np.searchsorted(dates, end, side='right'))
+    mig = np.load(path, mmap_mode='r')[first:last]
+    return dates[first:last], index['countries'], mig
@@ -0,0 +1,505 @@
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+from schedule import MigrationSchedule
+import profiling
+
+
+def issparse(matrix):
+    return sp is not None and sp.issparse(matrix)
+
+
+def migration_operator(mig, N):
+    """
+    Function computing the linear operator applying the daily migrations to the compartments of every country.
+    Multiplying a vector of compartment sizes by this operator gives the same result as the migration function of
+    Country.py : country i sends the fraction mig[i][j]/N[i] of each of its compartments to country j and receives the
+    same fraction of the compartments of every country j sending people to it.
+    :param mig: the number of daily movers between each pair of country, of shape (..., n, n), or a sparse matrix of
+    shape (n, n)
+    :param N: the total population of each country, of shape (n,)
+    :return: the migration operator, of shape (..., n, n), sparse in CSR format if mig is sparse
+    """
+    N = np.asarray(N, dtype=float)
+    if issparse(mig):
+        prop = sp.diags(1.0 / N) @ sp.csr_matrix(mig, dtype=float)
+        return (prop.T + sp.diags(1.0 - np.asarray(prop.sum(axis=1)).ravel())).tocsr()
+    mig = np.asarray(mig, dtype=float)
+    n = N.shape[0]
+    # row-normalized flows : prop[i][j] is the fraction of the population of i moving to j
+    prop = mig / N[:, None]
+    op = np.swapaxes(prop, -1, -2).copy()
+    idx = np.arange(n)
+    op[..., idx, idx] += 1.0 - prop.sum(axis=-1)
+    return op
+
+
+class _LazyOperators:
+    """
+    The class object representing the migration operators of a sequence of dense migration matrices, such as the days
+    of a memory-mapped (Horizon, n, n) matrix, computed when they are indexed instead of all of them being stacked in
+    memory. Indexed by a time step, the operators are computed by blocks of consecutive matrices, so that stepping
+    through the days in order computes each operator once. Indexed by an array, as for one operator per scenario, the
+    operators of the last indexing are kept, and its result is returned again while the indexes do not change.
+    """
+    def __init__(self, matrices, N, block=32):
+        """
+        Construction method
+        :param matrices: the sequence of migration matrices of shape (n, n), an array or a list
+        :param N: the total population of each country, of shape (n,)
+        :param block: the number of operators computed together
+        """
+        self.matrices = matrices
+        self.N = N
+        self.block = block
+        self._first, self._ops = 0, None
+        self._cache = {}
+        self._keys, self._stacked = None, None
+
+    def __len__(self):
+        return len(self.matrices)
+
+    @property
+    def shape(self):
+        return (len(self.matrices),) + tuple(self.matrices[0].shape)
+
+    def __getitem__(self, k):
+        if isinstance(k, (int, np.integer)):
+            if self._ops is None or not 0 <= k - self._first < self._ops.shape[0]:
+                self._first = int(k)
+                self._ops = migration_operator(np.stack(self.matrices[k:k + self.block]), self.N)
+            return self._ops[k - self._first]
+        if self._keys is not None and np.array_equal(k, self._keys):
+            return self._stacked
+        keys, inverse = np.unique(k, return_inverse=True)
+        self._cache = {key: self._cache[key] if key in self._cache else migration_operator(self.matrices[key], self.N)
+                       for key in keys.tolist()}
+        self._keys = np.array(k)
+        self._stacked = np.stack([self._cache[key] for key in keys.tolist()])[inverse.reshape(np.shape(k))]
+        return self._stacked
+
+    def __array__(self, dtype=None, copy=None):
+        ops = migration_operator(np.stack(self.matrices), self.N)
+        return ops if dtype is None else ops.astype(dtype, copy=False)
+
+
+def operator_schedule(mig, N, Horizon, start=0, lazy=False):
+    """
+    Function computing the migration operators needed for a simulation. For a MigrationSchedule the operator is computed
+    once per segment instead of once per time step.
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule
+    :param N: the total population of each country, of shape (n,)
+    :param Horizon: the range period in terms of days for the simulation
+    :param start: the first time step for which the operator is needed
+    :param lazy: if True, the dense operators are computed when they are indexed (see _LazyOperators) instead of being
+    stacked in an array, so that a memory-mapped migration matrix is read day by day and never held whole in memory
+    :return: the operators of shape (number of operators, n, n), or a list of sparse operators for a schedule of sparse
+    matrices, and the array of shape (Horizon,) giving the index of the operator of each time step from start
+    """
+    if isinstance(mig, MigrationSchedule):
+        day = mig.day_index(Horizon)
+        first, last = day[min(start, Horizon - 1)], day[-1] + 1
+        if issparse(mig.matrices[0]):
+            return [migration_operator(m, N) for m in mig.matrices[first:last]], day - first
+        if lazy:
+            return _LazyOperators(mig.matrices[first:last], N), day - first
+        return migration_operator(np.stack(mig.matrices[first:last]), N), day - first
+    if lazy:
+        return _LazyOperators(np.asarray(mig, dtype=float)[start:Horizon], N), np.arange(Horizon) - start
+    return migration_operator(np.asarray(mig, dtype=float)[start:Horizon], N), np.arange(Horizon) - start
+
+
+def _scenario_operators(migs, N, Horizon, lazy=False):
+    """
+    Function computing the migration operators of several scenarios, each one having its own migration matrix
+    :param migs: an array of shape (B, Horizon, n, n) or a list of migration matrices or MigrationSchedule
+    :return: the operators of every scenario concatenated, of shape (number of operators, n, n) and the array of shape
+    (B, Horizon) giving the index of the operator of each scenario on each time step. For sparse matrices, the operators
+    of the scenarios are instead assembled in block diagonal operators, with one index per time step. With lazy, the
+    dense operators are computed when they are indexed, as in operator_schedule.
+    """
+    # the operators of a migration matrix shared by several scenarios are computed once
+    unique, index = {}, []
+    for mig in migs:
+        index.append(unique.setdefault(id(mig), (len(unique), mig))[0])
+    computed = [operator_schedule(mig, N, Horizon, lazy=lazy) for k, mig in unique.values()]
+    if isinstance(computed[0][0], list):
+        scenarios = [computed[k] for k in index]
+        days = np.stack([day for op, day in scenarios])
+        # a new block diagonal operator is needed each time one of the scenarios changes of operator
+        changes = np.concatenate([[0], np.nonzero(np.any(days[:, 1:] != days[:, :-1], axis=0))[0] + 1])
+        ops = [sp.block_diag([op[d] for (op, day), d in zip(scenarios, days[:, t])], format='csr') for t in changes]
+        return ops, np.searchsorted(changes, np.arange(Horizon), side='right') - 1
+    ops, offsets, offset = [], [], 0
+    for op, day in computed:
+        ops.append(op)
+        offsets.append(offset)
+        offset += len(op)
+    days = np.stack([computed[k][1] + offsets[k] for k in index])
+    if lazy:
+        return _LazyOperators([m for op in ops for m in op.matrices], N), days
+    return np.concatenate(ops), days
+
+
+def sir_step(S, I, R, N, beta, gamma):
+    """
+    Function applying one day of the classic SIR model inside each country, exactly as Country.simulate does.
+    Every argument can have arbitrary leading dimensions as long as they broadcast together.
+    :param S: number of suspected individuals on the previous time step
+    :param I: number of infected individuals on the previous time step
+    :param R: number of recovered individuals on the previous time step
+    :param N: total population of each country
+    :param beta: contact rate of the virus on the current time step
+    :param gamma: recovery rate of the virus
+    :return: the number of suspected, infected and recovered individuals on the current time step
+    """
+    dS = -beta * S * I / N
+    dI = beta * S * I / N - gamma * I
+    dR = gamma * I
+    return S + dS, I + dI, R + dR
+
+
+def apply_migration(op, X):
+    """
+    Function applying the migration operator of one time step to the compartments of every country.
+    :param op: the migration operator of the time step, of shape (n, n) or (B, n, n) for one operator per scenario,
+    or a sparse operator of shape (n, n) or (B * n, B * n) for a block diagonal operator with one block per scenario
+    :param X: the compartments sizes, of shape (..., n) or (B, ..., n) for one operator per scenario
+    :return: the compartments sizes after the migrations, of shape (..., n)
+    """
+    if issparse(op):
+        n = X.shape[-1]
+        if op.shape[0] != n:
+            # block diagonal operator : the scenarios are laid out one after the other
+            Xr = np.moveaxis(X, 0, -2)
+            Y = (op @ Xr.reshape(-1, op.shape[0]).T).T.reshape(Xr.shape)
+            return np.moveaxis(Y, -2, 0)
+        return (op @ X.reshape(-1, n).T).T.reshape(X.shape)
+    return X @ np.swapaxes(op, -1, -2)
+
+
+def simulate_arrays(N, beta, gamma, mig, S0, I0, R0, Horizon, start=1, states=None, progress=None):
+    """
+    Function simulating the spread of a virus in an ensemble of countries following a Multi-Country SIR model, with
+    the state of every country held in NumPy arrays. One day costs a few array operations instead of a Python loop over
+    the countries and the pairs of countries.
+    The states of the days before start can be given as a checkpoint, the simulation then resumes from day start, which
+    is enough after a modification of the migration matrix from day start onwards.
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus, scalar or of shape (n,) or (Horizon, n) for per-day values
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix containing the number of daily movers between each pair of country for each time
+    step, of shape (Horizon, n, n), or a MigrationSchedule
+    :param S0: number of suspected individuals in each country at time step 0
+    :param I0: number of infected individuals in each country at time step 0
+    :param R0: number of recovered individuals in each country at time step 0
+    :param Horizon: the range period in terms of days for the simulation
+    :param start: the first time step to simulate
+    :param states: the array of shape (Horizon, 3, n) of the suspected, infected and recovered individuals of every
+    country whose time steps before start are used as checkpoint instead of S0, I0 and R0. It is filled in place.
+    :param progress: if given, function called after each time step t with t and the array of shape (Horizon, 3, n) of
+    the states, filled up to time step t
+    :return: the arrays S, I and R of shape (Horizon, n) with the evolution of each compartment in each country
+    """
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), (Horizon, n)) if np.ndim(beta) < 2 \
+        else np.asarray(beta, dtype=float)
+    gamma = np.asarray(gamma, dtype=float)
+    start = max(start, 1)
+    with profiling.phase('migration_operator'):
+        op, day = operator_schedule(mig, N, Horizon, start, lazy=True)
+    profiling.count('days', Horizon - start)
+    profiling.count('pair_exchanges', (Horizon - start) * n * (n - 1))
+
+    step, migrate = profiling.wrap('sir_step', sir_step), profiling.wrap('migration', apply_migration)
+    if states is None:
+        X = np.zeros((Horizon, 3, n))
+        X[0, 0], X[0, 1], X[0, 2] = S0, I0, R0
+    else:
+        X = states
+    for t in range(start, Horizon):
+        X[t] = step(X[t - 1, 0], X[t - 1, 1], X[t - 1, 2], N, beta[t], gamma)
+        X[t] = migrate(op[day[t]], X[t])
+        if progress is not None:
+            progress(t, X)
+    return X[:, 0], X[:, 1], X[:, 2]
+
+
+def scenario_grid(origin, beta, gamma, I0):
+    """
+    Function building the cartesian product of the values of the parameters of a sweep
+    :param origin: index or list of indexes of the origin countries of the virus
+    :param beta: value or list of values of the contact rate of the virus
+    :param gamma: value or list of values of the recovery rate of the virus
+    :param I0: value or list of values of the number of infected individuals in the origin country at time step 0
+    :return: the flattened arrays origin, beta, gamma and I0 with one entry per scenario
+    """
+    grids = np.meshgrid(np.atleast_1d(origin), np.atleast_1d(beta), np.atleast_1d(gamma), np.atleast_1d(I0),
+                        indexing='ij')
+    origin, beta, gamma, I0 = [g.ravel() for g in grids]
+    return origin.astype(int), beta.astype(float), gamma.astype(float), I0.astype(float)
+
+
+def initial_infected(n, origin, I0):
+    """
+    Function creating the number of infected individuals in each country at time step 0 for each scenario
+    :param n: the number of countries
+    :param origin: the index of the origin country of the virus of each scenario, of shape (B,)
+    :param I0: number of infected individuals in the origin country at time step 0 of each scenario
+    :return: the array of shape (B, n) of infected individuals at time step 0
+    """
+    origin = np.atleast_1d(origin)
+    I = np.zeros((origin.shape[0], n))
+    I[np.arange(origin.shape[0]), origin] = I0
+    return I
+
+
+def _batch_rates(beta, gamma, B):
+    """
+    Function reshaping the rates of the scenarios of a batch so that they can be indexed by scenario and by time step
+    :return: beta of shape (B, 1 or Horizon, 1 or n) and gamma of shape (B, 1 or n)
+    """
+    beta = np.asarray(beta, dtype=float)
+    if beta.ndim < 3:
+        beta = np.broadcast_to(beta, (B,)) if beta.ndim == 0 else beta
+        beta = beta.reshape(B, 1, -1)
+    gamma = np.asarray(gamma, dtype=float)
+    gamma = (np.broadcast_to(gamma, (B,)) if gamma.ndim == 0 else gamma).reshape(B, -1)
+    return beta, gamma
+
+
+def attack_rate(X):
+    """
+    Function computing the share of the population of each country which has been infected
+    :param X: the compartments sizes, of shape (..., 3, n)
+    :return: the attack rates, of shape (..., n)
+    """
+    return (X[..., 1, :] + X[..., 2, :]) / X.sum(axis=-2)
+
+
+def peak_time(I):
+    """
+    Function computing the time of the peak of the infected individuals with a sub-day precision, by fitting a parabola
+    on the day of the maximum and its two neighbours. Unlike the day of the maximum, it varies continuously with the
+    parameters of the simulation, so that small effects such as the one of a single travel ban are visible, and it can
+    be differentiated, see migration_sensitivity.
+    :param I: the infected individuals of shape (..., Horizon, n)
+    :return: the times of the peaks of shape (..., n)
+    """
+    H = I.shape[-2]
+    k = np.argmax(I, axis=-2)
+    inner = np.clip(k, 1, H - 2)
+    y0, y1, y2 = (np.take_along_axis(I, np.expand_dims(inner + d, -2), axis=-2)[..., 0, :] for d in (-1, 0, 1))
+    curvature = y0 - 2 * y1 + y2
+    offset = np.where(curvature < 0, (y0 - y2) / (2 * np.where(curvature < 0, curvature, -1.0)), 0.0)
+    return np.where((k > 0) & (k < H - 1), inner + np.clip(offset, -0.5, 0.5), k)
+
+
+def simulate_batch(N, beta, gamma, mig, I0, Horizon, S0=None, R0=None, chunk_size=1024, summary=False,
+                   stop_threshold=None, patience=1):
+    """
+    Function simulating a batch of scenarios of the Multi-Country SIR model together. The state of the scenarios is
+    advanced as arrays of shape (scenarios, n), so that a whole sweep over the origin country and the parameters of the
+    virus costs the same number of array operations as a single simulation. The scenario axis is processed by chunks
+    of chunk_size scenarios to keep the memory bounded.
+    With stop_threshold, a scenario is terminated as soon as, for patience consecutive days, the number of infected
+    individuals is below the threshold and not increasing in every country. The terminated scenarios are removed from
+    the active set, so that the following days are only computed for the scenarios still running.
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus, of shape (B,), (B, n) or (B, Horizon, n)
+    :param gamma: recovery rate of the virus, of shape (B,) or (B, n)
+    :param mig: the migration matrix or MigrationSchedule shared by every scenario, or one migration matrix per
+    scenario, as an array of shape (B, Horizon, n, n) or a list of B migration matrices or MigrationSchedule
+    :param I0: number of infected individuals in each country at time step 0, of shape (B, n)
+    :param Horizon: the range period in terms of days for the simulation
+    :param S0: number of suspected individuals at time step 0, of shape (B, n), by default N - I0 - R0
+    :param R0: number of recovered individuals at time step 0, of shape (B, n), by default 0
+    :param chunk_size: the maximum number of scenarios simulated together
+    :param summary: if True, only the summary statistics of each scenario are kept instead of the trajectories
+    :param stop_threshold: number of infected individuals under which a country is considered as done, None to always
+    simulate until Horizon
+    :param patience: number of consecutive days the termination criterion must hold
+    :return: the array of shape (B, Horizon, n) of infected individuals for each scenario, whose days after the
+    termination of a scenario are NaN, or if summary is True a dictionary with the peak day, the peak value and the
+    attack rate of each country in each scenario, of shape (B, n), and the number of days simulated in each scenario,
+    of shape (B,)
+    """
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    I0 = np.asarray(I0, dtype=float)
+    B = I0.shape[0]
+    R0 = np.zeros((B, n)) if R0 is None else np.broadcast_to(np.asarray(R0, dtype=float), (B, n))
+    S0 = N - I0 - R0 if S0 is None else np.broadcast_to(np.asarray(S0, dtype=float), (B, n))
+    beta, gamma = _batch_rates(beta, gamma, B)
+    per_day = beta.shape[1] > 1
+    per_scenario = isinstance(mig, list) or (not isinstance(mig, MigrationSchedule) and np.ndim(mig) == 4)
+    if not per_scenario:
+        with profiling.phase('migration_operator'):
+            op, day = operator_schedule(mig, N, Horizon, lazy=True)
+
+    step, migrate = profiling.wrap('sir_step', sir_step), profiling.wrap('migration', apply_migration)
+    if summary:
+        out = {'peak_day': np.zeros((B, n), dtype=int), 'peak_value': np.zeros((B, n)), 'attack_rate': np.zeros((B, n)),
+               'days': np.full(B, Horizon)}
+    else:
+        out = np.zeros((B, Horizon, n))
+    for start in range(0, B, chunk_size):
+        # global indexes of the scenarios of the chunk still running
+        active = np.arange(start, min(start + chunk_size, B))
+        if per_scenario:
+            migs = mig[start:active[-1] + 1]
+            with profiling.phase('migration_operator'):
+                op, day = _scenario_operators(migs, N, Horizon, lazy=True)
+            blocks = isinstance(op, list)
+        X = np.stack([S0[active], I0[active], R0[active]], axis=1)
+        beta_c, gamma_c = beta[start:active[-1] + 1], gamma[start:active[-1] + 1]
+        peak_day = np.zeros((active.shape[0], n), dtype=int)
+        peak_value = X[:, 1].copy()
+        calm = np.zeros(active.shape[0], dtype=int)
+        if not summary:
+            out[active, 0] = X[:, 1]
+        for t in range(1, Horizon):
+            previous = X[:, 1]
+            if profiling.enabled:
+                profiling.count('days', active.shape[0])
+                profiling.count('pair_exchanges', active.shape[0] * n * (n - 1))
+            X = np.stack(step(X[:, 0], X[:, 1], X[:, 2], N, beta_c[:, t if per_day else 0], gamma_c), axis=1)
+            X = migrate(op[day[:, t]] if per_scenario and not blocks else op[day[t]], X)
+            higher = X[:, 1] > peak_value
+            peak_day[higher] = t
+            peak_value[higher] = X[:, 1][higher]
+            if not summary:
+                out[active, t] = X[:, 1]
+            if stop_threshold is None or t == Horizon - 1:
+                continue
+            calm = np.where(np.all((X[:, 1] < stop_threshold) & (X[:, 1] <= previous), axis=1), calm + 1, 0)
+            done = calm >= patience
+            if done.any():
+                if summary:
+                    out['peak_day'][active[done]] = peak_day[done]
+                    out['peak_value'][active[done]] = peak_value[done]
+                    out['attack_rate'][active[done]] = attack_rate(X[done])
+                    out['days'][active[done]] = t + 1
+                else:
+                    out[active[done], t + 1:] = np.nan
+                keep = ~done
+                if per_scenario and not blocks:
+                    day = day[keep]
+                elif per_scenario:
+                    migs = [m for m, k in zip(migs, keep) if k]
+                    op, day = _scenario_operators(migs, N, Horizon, lazy=True) if migs else (op, day)
+                active, X, peak_day, peak_value, calm = active[keep], X[keep], peak_day[keep], peak_value[keep], calm[keep]
+                beta_c, gamma_c = beta_c[keep], gamma_c[keep]
+                if active.shape[0] == 0:
+                    break
+        if summary and active.shape[0] > 0:
+            out['peak_day'][active] = peak_day
+            out['peak_value'][active] = peak_value
+            out['attack_rate'][active] = attack_rate(X)
+    return out
+
+
+def _output_seeds(I, output, threshold):
+    """
+    Function computing the outputs of a simulation for each country and their derivatives with respect to the infected
+    individuals of each time step, see migration_sensitivity
+    :return: the outputs of shape (n,) and the derivatives of shape (Horizon, n), the output of country k depending
+    only on the infected individuals of country k
+    """
+    H, n = I.shape
+    seeds = np.zeros((H, n))
+    cols = np.arange(n)
+    if output == 'peak':
+        value = peak_time(I)
+        k = np.argmax(I, axis=0)
+        inner = np.clip(k, 1, H - 2)
+        y0, y1, y2 = I[inner - 1, cols], I[inner, cols], I[inner + 1, cols]
+        c, d = y0 - 2 * y1 + y2, y0 - y2
+        smooth = (k > 0) & (k < H - 1) & (c < 0) & (np.abs(d) < -c)
+        c = np.where(smooth, c, -1.0)
+        seeds[inner - 1, cols] = np.where(smooth, (c - d) / (2 * c ** 2), 0.0)
+        seeds[inner, cols] = np.where(smooth, d / c ** 2, 0.0)
+        seeds[inner + 1, cols] = np.where(smooth, (-c - d) / (2 * c ** 2), 0.0)
+        return value, seeds
+    # arrival : time at which the infected individuals reach the threshold, interpolated linearly between two days
+    above = I >= threshold
+    t = np.where(above.any(axis=0), np.argmax(above, axis=0), H)
+    inside = (t > 0) & (t < H)
+    t1 = np.clip(t, 1, H - 1)
+    a, b = I[t1 - 1, cols], I[t1, cols]
+    delta = np.where(inside, b - a, 1.0)
+    value = np.where(inside, t1 - 1 + (threshold - a) / delta, np.where(t == 0, 0.0, np.nan))
+    seeds[t1 - 1, cols] = np.where(inside, (threshold - b) / delta ** 2, 0.0)
+    seeds[t1, cols] = np.where(inside, -(threshold - a) / delta ** 2, 0.0)
+    return value, seeds
+
+
+def migration_sensitivity(N, beta, gamma, mig, S0, I0, R0, Horizon, output='peak', threshold=1.0):
+    """
+    Function computing the derivative of an output of the simulation of each country with respect to every entry of the
+    migration matrix, by the adjoint method : one forward simulation, then one backward pass through the transposed
+    steps carrying the adjoints of the n outputs together, instead of one simulation per pair of countries.
+    An entry mig[i, j] is perturbed on every time step, so for a MigrationSchedule the derivative is the one of a
+    change of the entry in every segment. The diagonal of the migration matrix has no effect and a null derivative.
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus, scalar or of shape (n,) or (Horizon, n) for per-day values
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule, dense
+    :param S0: number of suspected individuals in each country at time step 0
+    :param I0: number of infected individuals in each country at time step 0
+    :param R0: number of recovered individuals in each country at time step 0
+    :param Horizon: the range period in terms of days for the simulation
+    :param output: 'peak' for the time of the peak of the infected individuals (see peak_time), 'arrival' for the time
+    at which the infected individuals reach threshold, or 'cumulative' for the total number of infections
+    :param threshold: the number of infected individuals defining the arrival of the virus
+    :return: the outputs of shape (n,) and the sensitivity tensor of shape (n, n, n), whose entry [k, i, j] is the
+    derivative of the output of country k with respect to the number of daily movers from country i to country j
+    """
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), (Horizon, n)) if np.ndim(beta) < 2 \
+        else np.asarray(beta, dtype=float)
+    gamma = np.asarray(gamma, dtype=float)
+    op, day = operator_schedule(mig, N, Horizon)
+    op_t = np.swapaxes(op, -1, -2)
+
+    # forward pass, keeping the compartments before (Y) and after (X) the migration step
+    X = np.zeros((Horizon, 3, n))
+    Y = np.zeros((Horizon, 3, n))
+    X[0, 0], X[0, 1], X[0, 2] = S0, I0, R0
+    for t in range(1, Horizon):
+        Y[t] = sir_step(X[t - 1, 0], X[t - 1, 1], X[t - 1, 2], N, beta[t], gamma)
+        X[t] = apply_migration(op[day[t]], Y[t])
+
+    eye = np.eye(n)
+    if output == 'cumulative':
+        value = (beta[1:] * X[:-1, 0] * X[:-1, 1] / N).sum(axis=0)
+        seeds, d_cases = np.zeros((Horizon, n)), eye
+    else:
+        value, seeds = _output_seeds(X[:, 1], output, threshold)
+        d_cases = np.zeros((n, n))
+
+    # backward pass : lam[k] is the derivative of the output of country k with respect to the state of time step t
+    lam = np.zeros((n, 3, n))
+    G = np.zeros((n, n, n))
+    for t in range(Horizon - 1, 0, -1):
+        lam[:, 1] += eye * seeds[t]
+        # derivative with respect to the entries of the migration operator
+        G += np.einsum('kca,cb->kab', lam, Y[t])
+        mu = apply_migration(op_t[day[t]], lam)
+        S, I = X[t - 1, 0], X[t - 1, 1]
+        g = mu[:, 1] - mu[:, 0] + d_cases
+        lam = np.stack([mu[:, 0] + g * beta[t] * I / N,
+                        mu[:, 1] + g * beta[t] * S / N + gamma * (mu[:, 2] - mu[:, 1]),
+                        mu[:, 2]], axis=1)
+
+    # op[j, i] = mig[i, j] / N[i] for i != j and op[i, i] = 1 - sum of mig[i, j] / N[i] over j != i
+    diag = np.diagonal(G, axis1=1, axis2=2)
+    sensitivity = (np.swapaxes(G, 1, 2) - diag[:, :, None]) / N[None, :, None]
+    sensitivity[:, np.arange(n), np.arange(n)] = 0.0
+    return value, sensitivity
@@ -0,0 +1,157 @@
+import numpy as np
+
+from engine import migration_operator, operator_schedule, apply_migration, issparse, sp
+from schedule import MigrationSchedule
+
+# Dormand-Prince 5(4) coefficients
+_A = [[],
+      [1 / 5],
+      [3 / 40, 9 / 40],
+      [44 / 45, -56 / 15, 32 / 9],
+      [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+      [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+      [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]]
+_B5 = np.array([35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0])
+_B4 = np.array([5179 / 57600, 0.0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40])
+
+
+def rate_matrix(mig, N):
+    """
+    Function computing the migration expressed as a rate : the derivative of the compartments due to the migrations is
+    the product of this matrix with the compartments. It is the migration operator of one day minus the identity.
+    :param mig: the number of daily movers between each pair of country, of shape (n, n), dense or sparse
+    :param N: the total population of each country, of shape (n,)
+    :return: the rate matrix of shape (n, n)
+    """
+    return _rate(migration_operator(mig, N))
+
+
+def _rate(op):
+    if issparse(op):
+        return (op - sp.identity(op.shape[0], format='csr')).tocsr()
+    return op - np.eye(op.shape[0])
+
+
+def derivative(X, N, beta, gamma, L):
+    """
+    Function computing the derivative of the compartments of the continuous-time Multi-Country SIR model
+    :param X: the compartments sizes, of shape (..., 3, n)
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus
+    :param gamma: recovery rate of the virus
+    :param L: the migration rate matrix of shape (n, n), see rate_matrix
+    :return: the derivative of shape (..., 3, n)
+    """
+    S, I = X[..., 0, :], X[..., 1, :]
+    infections = beta * S * I / N
+    recoveries = gamma * I
+    return np.stack([-infections, infections - recoveries, recoveries], axis=-2) + apply_migration(L, X)
+
+
+def _hermite(X0, F0, X1, F1, h, s):
+    # cubic Hermite interpolation at the fraction s of a step of length h
+    h00, h10 = 2 * s ** 3 - 3 * s ** 2 + 1, s ** 3 - 2 * s ** 2 + s
+    h01, h11 = -2 * s ** 3 + 3 * s ** 2, s ** 3 - s ** 2
+    return h00 * X0 + h10 * h * F0 + h01 * X1 + h11 * h * F1
+
+
+def _segments(mig, beta, N, Horizon, start):
+    """
+    Function splitting the simulated period in intervals on which beta and the migration matrix are constant. In the
+    daily model, time step t uses beta[t] and mig[t], so they apply on the interval [t - 1, t].
+    :return: a list of tuples (first day, last day, index of the rate matrix, index of the row of beta) and the rate
+    matrices
+    """
+    if not isinstance(mig, MigrationSchedule):
+        # the identical consecutive days of a dense matrix share one operator, so that the integration only restarts
+        # when the migration changes
+        mig = MigrationSchedule.from_dense(np.asarray(mig, dtype=float)[:Horizon])
+    ops, day = operator_schedule(mig, N, Horizon, start)
+    rates = [_rate(op) for op in ops]
+    segments = []
+    for t in range(start, Horizon):
+        if segments and day[t] == segments[-1][2] and np.array_equal(beta[t], beta[segments[-1][3]]):
+            segments[-1][1] = t
+        else:
+            segments.append([t - 1, t, day[t], t])
+    return segments, rates
+
+
+def integrate(N, beta, gamma, mig, S0, I0, R0, Horizon, method='rk45', h=1.0, rtol=1e-6, atol=1e-3,
+              max_step=np.inf, start=1, states=None):
+    """
+    Function simulating the Multi-Country SIR model in continuous time, with the local SIR dynamics and the migrations
+    expressed as rates integrated together, instead of the daily SIR step followed by the migration step of
+    Country.simulate and migration. The solution is interpolated back on the daily grid.
+    The integration restarts on each day where beta or the migration matrix changes, so that the right-hand side is
+    smooth on every interval.
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus, scalar or of shape (n,) or (Horizon, n) for per-day values
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule
+    :param S0: number of suspected individuals in each country at time step 0
+    :param I0: number of infected individuals in each country at time step 0
+    :param R0: number of recovered individuals in each country at time step 0
+    :param Horizon: the range period in terms of days for the simulation
+    :param method: 'rk4' for the classic Runge-Kutta method with a fixed step h, or 'rk45' for the Dormand-Prince
+    embedded method with an adaptive step controlled by rtol and atol
+    :param h: the step in days of 'rk4', and the first step tried by 'rk45'
+    :param rtol: the relative tolerance of 'rk45'
+    :param atol: the absolute tolerance of 'rk45', in number of individuals
+    :param max_step: the maximum step in days of 'rk45'
+    :param start: the first time step to simulate, as in simulate_arrays
+    :param states: the array of shape (Horizon, 3, n) whose time steps before start are used as checkpoint
+    :return: the arrays S, I and R of shape (Horizon, n) on the daily grid, and the number of evaluations of the
+    right-hand side
+    """
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), (Horizon, n)) if np.ndim(beta) < 2 \
+        else np.asarray(beta, dtype=float)
+    gamma = np.asarray(gamma, dtype=float)
+    start = max(start, 1)
+    if states is None:
+        X = np.zeros((Horizon, 3, n))
+        X[0, 0], X[0, 1], X[0, 2] = S0, I0, R0
+    else:
+        X = states
+    segments, rates = _segments(mig, beta, N, Horizon, start)
+
+    nfev = 0
+    for t0, t1, k, b in segments:
+        def f(Y):
+            return derivative(Y, N, beta[b], gamma, rates[k])
+        Y, t = X[t0].copy(), float(t0)
+        F = f(Y)
+        nfev += 1
+        step = min(h, t1 - t0, max_step)
+        while t < t1 - 1e-9:
+            step = min(step, t1 - t)
+            if method == 'rk4':
+                k2 = f(Y + step / 2 * F)
+                k3 = f(Y + step / 2 * k2)
+                k4 = f(Y + step * k3)
+                Y1 = Y + step / 6 * (F + 2 * k2 + 2 * k3 + k4)
+                F1 = f(Y1)
+                nfev += 4
+                new_step = step
+            else:
+                K = [F]
+                for i in range(1, 7):
+                    K.append(f(Y + step * sum(a * K[j] for j, a in enumerate(_A[i]) if a != 0.0)))
+                nfev += 6
+                Y1, F1 = Y + step * sum(b5 * K[j] for j, b5 in enumerate(_B5) if b5 != 0.0), K[6]
+                error = step * sum((b5 - b4) * K[j] for j, (b5, b4) in enumerate(zip(_B5, _B4)))
+                scale = atol + rtol * np.maximum(np.abs(Y), np.abs(Y1))
+                norm = np.sqrt(np.mean((error / scale) ** 2))
+                new_step = min(step * min(5.0, max(0.2, 0.9 * (norm + 1e-16) ** -0.2)), max_step)
+                if norm > 1.0:
+                    step = new_step
+                    continue
+            # the days reached during the step are interpolated
+            for d in range(int(np.floor(t)) + 1, int(np.floor(t + step + 1e-9)) + 1):
+                X[d] = _hermite(Y, F, Y1, F1, step, (d - t) / step)
+            Y, F, t = Y1, F1, t + step
+            step = new_step
+        X[t1] = Y
+    return X[:, 0], X[:, 1], X[:, 2], nfev
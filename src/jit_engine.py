@@ -0,0 +1,134 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import engine
+from engine import operator_schedule, _scenario_operators, _batch_rates, issparse
+from schedule import MigrationSchedule
+import profiling
+
+
+def _kernel(N, beta, gamma, ops, day, X0, Horizon, use_stop, stop_threshold, patience, summary,
+            traj, peak_day, peak_value, attack, days):
+    """
+    Native loop over the days of the local SIR step of Country.simulate fused with the migration step of migration,
+    for each scenario independently. The arithmetic is written in the same order as in engine.py.
+    """
+    B, _, n = X0.shape
+    for b in numba.prange(B):
+        S, I, R = X0[b, 0].copy(), X0[b, 1].copy(), X0[b, 2].copy()
+        S2, I2, R2 = np.empty(n), np.empty(n), np.empty(n)
+        for i in range(n):
+            peak_value[b, i] = I[i]
+            peak_day[b, i] = 0
+            if not summary:
+                traj[b, 0, i] = I[i]
+        days[b] = Horizon
+        calm = 0
+        for t in range(1, Horizon):
+            tb = t if beta.shape[1] > 1 else 0
+            for i in range(n):
+                be = beta[b, tb, i if beta.shape[2] > 1 else 0]
+                ga = gamma[b, i if gamma.shape[1] > 1 else 0]
+                dS = -be * S[i] * I[i] / N[i]
+                dI = be * S[i] * I[i] / N[i] - ga * I[i]
+                dR = ga * I[i]
+                S2[i] = S[i] + dS
+                I2[i] = I[i] + dI
+                R2[i] = R[i] + dR
+            if day.shape[0] > 1:
+                op = ops[day[b, t]]
+            else:
+                op = ops[day[0, t]]
+            quiet = True
+            for i in range(n):
+                s, x, r = 0.0, 0.0, 0.0
+                for j in range(n):
+                    s += op[i, j] * S2[j]
+                    x += op[i, j] * I2[j]
+                    r += op[i, j] * R2[j]
+                if not (x < stop_threshold and x <= I[i]):
+                    quiet = False
+                S[i], I[i], R[i] = s, x, r
+                if x > peak_value[b, i]:
+                    peak_value[b, i] = x
+                    peak_day[b, i] = t
+                if not summary:
+                    traj[b, t, i] = x
+            if use_stop and t < Horizon - 1:
+                calm = calm + 1 if quiet else 0
+                if calm >= patience:
+                    days[b] = t + 1
+                    if not summary:
+                        traj[b, t + 1:, :] = np.nan
+                    break
+        for i in range(n):
+            attack[b, i] = (I[i] + R[i]) / (S[i] + I[i] + R[i])
+
+
+if numba is not None:
+    _kernel = numba.njit(parallel=True, cache=True)(_kernel)
+
+
+def available():
+    """
+    Function telling if the JIT backend can be used, i.e. if Numba is installed
+    """
+    return numba is not None
+
+
+def simulate_batch(N, beta, gamma, mig, I0, Horizon, S0=None, R0=None, chunk_size=1024, summary=False,
+                   stop_threshold=None, patience=1):
+    """
+    Function simulating a batch of scenarios of the Multi-Country SIR model with a kernel compiled by Numba, looping
+    over the days, the scenarios (in parallel) and the countries natively instead of calling NumPy once per day.
+    It takes the same arguments and returns the same results as simulate_batch of engine.py, to which it falls back when
+    Numba is not installed or when the migration matrices are sparse. As in engine.py, the scenarios are simulated by
+    chunks of chunk_size scenarios, so that the operators of the scenarios with their own migration are built for one
+    chunk at a time.
+    """
+    if numba is None or (isinstance(mig, MigrationSchedule) and issparse(mig.matrices[0])) \
+            or (isinstance(mig, list) and isinstance(mig[0], MigrationSchedule) and issparse(mig[0].matrices[0])):
+        return engine.simulate_batch(N, beta, gamma, mig, I0, Horizon, S0=S0, R0=R0, chunk_size=chunk_size,
+                                     summary=summary, stop_threshold=stop_threshold, patience=patience)
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    I0 = np.asarray(I0, dtype=float)
+    B = I0.shape[0]
+    R0 = np.zeros((B, n)) if R0 is None else np.broadcast_to(np.asarray(R0, dtype=float), (B, n))
+    S0 = N - I0 - R0 if S0 is None else np.broadcast_to(np.asarray(S0, dtype=float), (B, n))
+    beta, gamma = _batch_rates(beta, gamma, B)
+    per_scenario = isinstance(mig, list) or (not isinstance(mig, MigrationSchedule) and np.ndim(mig) == 4)
+    if not per_scenario:
+        with profiling.phase('migration_operator'):
+            ops, day = operator_schedule(mig, N, Horizon)
+            ops, day = np.ascontiguousarray(ops), np.ascontiguousarray(day[None, :], dtype=np.int64)
+
+    traj = np.zeros((B, Horizon, n)) if not summary else np.zeros((1, 1, 1))
+    peak_day = np.zeros((B, n), dtype=np.int64)
+    peak_value = np.zeros((B, n))
+    attack = np.zeros((B, n))
+    days = np.zeros(B, dtype=np.int64)
+    for start in range(0, B, chunk_size):
+        end = min(start + chunk_size, B)
+        if per_scenario:
+            with profiling.phase('migration_operator'):
+                ops, day = _scenario_operators(mig[start:end], N, Horizon)
+                ops, day = np.ascontiguousarray(ops), np.ascontiguousarray(day, dtype=np.int64)
+        X0 = np.ascontiguousarray(np.stack([S0[start:end], I0[start:end], R0[start:end]], axis=1))
+        # the SIR and migration steps are fused in the kernel, which is timed as a whole
+        with profiling.phase('jit_kernel'):
+            _kernel(N, np.ascontiguousarray(beta[start:end]), np.ascontiguousarray(gamma[start:end]), ops, day, X0,
+                    Horizon, stop_threshold is not None, np.inf if stop_threshold is None else float(stop_threshold),
+                    patience, summary, traj if summary else traj[start:end], peak_day[start:end],
+                    peak_value[start:end], attack[start:end], days[start:end])
+    if profiling.enabled:
+        simulated = days.sum() if stop_threshold is not None else B * Horizon
+        profiling.count('days', int(simulated))
+        profiling.count('pair_exchanges', int(simulated) * n * (n - 1))
+    if summary:
+        return {'peak_day': peak_day, 'peak_value': peak_value, 'attack_rate': attack, 'days': days}
+    return traj
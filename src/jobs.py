@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class JobQueue:
+    """
+    The class object representing a queue of background jobs, such as long simulations, run by a pool of threads. The
+    state, the progress, the partial results and the results of the jobs are written in a directory acting as a local
+    broker, so that any worker process of the server can report on a job started by another one.
+    A job is identified by its key, typically the fingerprint of the scenario : submitting a key already queued,
+    running or done does not start a new job.
+    """
+    def __init__(self, directory, max_workers=2, stale=60.0, interval=0.5, ttl=3600.0):
+        """
+        Construction method
+        :param directory: the directory of the jobs, shared by the worker processes
+        :param max_workers: the number of threads running the jobs of this process
+        :param stale: the number of seconds without news after which a job queued or running is considered lost (its
+        process died) and can be submitted again
+        :param interval: the minimum number of seconds between two writes of the progress of a job
+        :param ttl: the number of seconds after which the files of a finished job are removed, see expire
+        """
+        self.directory = directory
+        self.stale = stale
+        self.interval = interval
+        self.ttl = ttl
+        self._expired = time.time()
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key, suffix):
+        if not key or not key.isalnum():
+            raise ValueError('invalid job key {!r}'.format(key))
+        return os.path.join(self.directory, key + suffix)
+
+    def _write_status(self, key, **status):
+        status['time'] = time.time()
+        tmp = self._path(key, '.{}.{}.tmp'.format(os.getpid(), threading.get_ident()))
+        with open(tmp, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp, self._path(key, '.json'))
+
+    def _write_arrays(self, key, suffix, arrays):
+        tmp = self._path(key, '.{}.{}.tmp.npz'.format(os.getpid(), threading.get_ident()))
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self._path(key, suffix))
+
+    def _read_arrays(self, key, suffix):
+        try:
+            with np.load(self._path(key, suffix)) as f:
+                return {name: f[name] for name in f.files}
+        except FileNotFoundError:
+            return None
+
+    def status(self, key):
+        """
+        Method reading the state of a job
+        :param key: the key of the job
+        :return: a dictionary with the state ('queued', 'running', 'done' or 'failed'), the progress as done and total,
+        the error message of a failed job and the time of the last news, or None for an unknown job
+        """
+        try:
+            with open(self._path(key, '.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Method starting a job unless the same key is already queued, running or done
+        :param key: the key of the job
+        :param function: the function of the job, called with the arguments and a keyword argument progress, a function
+        to call with the number of steps done, the total number of steps and optionally partial result arrays as keyword
+        arguments. It returns a dictionary of arrays.
+        :return: the key of the job
+        """
+        if time.time() - self._expired > self.ttl / 10:
+            self.expire()
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not future.done():
+                return key
+            status = self.status(key)
+            if status is not None and (status['state'] == 'done'
+                                       or (status['state'] in ('queued', 'running')
+                                           and time.time() - status['time'] < self.stale)):
+                return key
+            self._write_status(key, state='queued', done=0, total=0)
+            self._futures[key] = self._executor.submit(self._run, key, function, args, kwargs)
+        return key
+
+    def _run(self, key, function, args, kwargs):
+        last = [0.0]
+
+        def progress(done, total, **partial):
+            now = time.time()
+            if now - last[0] < self.interval and done < total:
+                return
+            last[0] = now
+            if partial:
+                self._write_arrays(key, '.partial.npz', partial)
+            self._write_status(key, state='running', done=done, total=total)
+
+        self._write_status(key, state='running', done=0, total=0)
+        try:
+            result = function(*args, progress=progress, **kwargs)
+            self._write_arrays(key, '.npz', result)
+        except Exception:
+            self._write_status(key, state='failed', done=0, total=0, error=traceback.format_exc(limit=5))
+            return
+        status = self.status(key) or {}
+        self._write_status(key, state='done', done=status.get('total', 0), total=status.get('total', 0))
+        try:
+            os.remove(self._path(key, '.partial.npz'))
+        except FileNotFoundError:
+            pass
+
+    def partial(self, key):
+        """
+        Method reading the last partial results of a running job
+        :return: the dictionary of arrays, or None if the job has not reported any yet
+        """
+        return self._read_arrays(key, '.partial.npz')
+
+    def result(self, key):
+        """
+        Method reading the results of a finished job
+        :return: the dictionary of arrays, or None if the job is not done
+        """
+        return self._read_arrays(key, '.npz')
+
+    def discard(self, key):
+        """
+        Method removing the files of a job which is not running in this process, typically once its result has been read
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and not future.done():
+                return
+            self._futures.pop(key, None)
+            for suffix in ('.json', '.npz', '.partial.npz'):
+                try:
+                    os.remove(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def expire(self, max_age=None):
+        """
+        Method removing the files of the jobs finished, failed or lost for more than max_age seconds, and the temporary
+        files left by the processes which died while writing
+        :param max_age: the age in seconds, by default the ttl of the queue
+        """
+        max_age = self.ttl if max_age is None else max_age
+        self._expired = now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            key = name.split('.')[0]
+            if '.tmp' in name:
+                try:
+                    if now - os.path.getmtime(path) > max_age:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            elif name.endswith('.json'):
+                status = self.status(key)
+                # a job queued or running is only removed once it is also lost
+                age = max_age if status is None or status['state'] in ('done', 'failed') else max(max_age, self.stale)
+                if status is not None and now - status['time'] > age:
+                    self.discard(key)
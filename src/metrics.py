@@ -0,0 +1,89 @@
+import numpy as np
+
+from engine import operator_schedule, attack_rate as _attack_rate
+
+
+def peak_day(I):
+    """
+    Function computing the day of the peak of the infected individuals of each country. The days after the early
+    termination of a scenario, filled with NaN by simulate_batch, are ignored.
+    :param I: the infected individuals of shape (..., Horizon, n), for instance (scenarios, Horizon, n)
+    :return: the days of the peaks of shape (..., n)
+    """
+    I = np.asarray(I, dtype=float)
+    return np.argmax(np.where(np.isnan(I), -np.inf, I), axis=-2)
+
+
+def peak_value(I):
+    """
+    Function computing the maximum number of infected individuals of each country
+    :param I: the infected individuals of shape (..., Horizon, n)
+    :return: the values of the peaks of shape (..., n)
+    """
+    I = np.asarray(I, dtype=float)
+    return np.max(np.where(np.isnan(I), -np.inf, I), axis=-2)
+
+
+def arrival_day(I, threshold=1.0):
+    """
+    Function computing the first day on which the number of infected individuals of each country reaches a threshold
+    :param I: the infected individuals of shape (..., Horizon, n)
+    :param threshold: the number of infected individuals defining the arrival of the virus
+    :return: the days of arrival of shape (..., n), -1 for the countries never reaching the threshold
+    """
+    above = np.asarray(I, dtype=float) >= threshold
+    return np.where(above.any(axis=-2), np.argmax(above, axis=-2), -1)
+
+
+def attack_rate(S, I, R):
+    """
+    Function computing the share of the population of each country which has been infected on the last simulated day
+    :param S: the suspected individuals of shape (..., Horizon, n)
+    :param I: the infected individuals of shape (..., Horizon, n)
+    :param R: the recovered individuals of shape (..., Horizon, n)
+    :return: the attack rates of shape (..., n)
+    """
+    S, I, R = (np.asarray(X, dtype=float) for X in (S, I, R))
+    # last day before the early termination of each scenario
+    last = np.maximum((~np.isnan(I)).sum(axis=-2, keepdims=True) - 1, 0)
+    X = np.stack([np.take_along_axis(X, last, axis=-2)[..., 0, :] for X in (S, I, R)], axis=-2)
+    return _attack_rate(X)
+
+
+def delay(days, origin):
+    """
+    Function computing the delay of a day (peak, arrival, ...) of each country relative to the one of the origin country
+    :param days: the days of shape (..., n), for instance (scenarios, n)
+    :param origin: the index of the origin country, scalar or of shape (...,) for one origin per scenario
+    :return: the delays of shape (..., n)
+    """
+    days = np.asarray(days)
+    origin = np.broadcast_to(np.asarray(origin, dtype=int), days.shape[:-1])
+    return days - np.take_along_axis(days, origin[..., None], axis=-1)
+
+
+def imported_share(S, I, N, beta, gamma, mig):
+    """
+    Function computing the share of the new infected individuals of each country which were imported by the migrations
+    rather than infected locally, over the whole simulation. On each day, the local cases are the infections of the SIR
+    step and the imported cases are the infected individuals arriving from the other countries in the migration step.
+    :param S: the suspected individuals of shape (..., Horizon, n)
+    :param I: the infected individuals of shape (..., Horizon, n)
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus, scalar or of shape (n,) or (Horizon, n) for per-day values
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule shared by every scenario, dense
+    :return: the imported shares of shape (..., n)
+    """
+    S, I = np.nan_to_num(np.asarray(S, dtype=float)), np.nan_to_num(np.asarray(I, dtype=float))
+    N = np.asarray(N, dtype=float)
+    Horizon, n = I.shape[-2:]
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), (Horizon, n)) if np.ndim(beta) < 2 \
+        else np.asarray(beta, dtype=float)
+    op, day = operator_schedule(mig, N, Horizon)
+    inflow = op * (1 - np.eye(n))
+    local = beta[1:] * S[..., :-1, :] * I[..., :-1, :] / N
+    moving = I[..., :-1, :] + local - np.asarray(gamma, dtype=float) * I[..., :-1, :]
+    imported = np.einsum('tij,...tj->...ti', inflow[day[1:]], moving)
+    imported, local = imported.sum(axis=-2), local.sum(axis=-2)
+    return imported / np.maximum(imported + local, np.finfo(float).tiny)
@@ -1,8 +1,8 @@
-import pandas as pd
+import json
+import os
 
-df_fb = pd.read_csv('../data/movement_countries.csv')
-countries = sorted(df_fb.end_name.unique())
-df_fb.rename(columns = {'ds':'date'}, inplace = True)
+import numpy as np
+import pandas as pd
 
 
 countries_name = ['austria','belgium' ,'croatia' ,'czechia' ,'denmark',
@@ -12,48 +12,149 @@ countries_name = ['austria','belgium' ,'croatia' ,'czechia' ,'denmark',
  'united kingdom', 'portugal', 'slovenia',  'hungary', 'poland',
  'bosnia and herzegovina', 'slovakia', 'bulgaria' ]
 
-df_fb = df_fb.replace({"start_name": {"czech republic":"czechia"}})
-df_fb = df_fb.replace({"end_name": {"czech republic":"czechia"}})
+baseline_start = '2020-02-29'
+baseline_end = '2020-03-06'
 
 
+def read_movements(path, baseline_start=baseline_start, baseline_end=baseline_end, countries=countries_name,
+                   chunksize=1_000_000):
+    """
+    Function reading the Facebook movement data by chunks and computing the mean daily travel counts between each pair
+    of countries over the baseline period. Each chunk is filtered and reduced to sums and counts per pair, so that the
+    memory used does not depend on the size of the file.
+    :param path: the path of the csv file with the columns ds, start_name, end_name and travel_counts
+    :param baseline_start: the first day of the baseline period, as 'YYYY-MM-DD'
+    :param baseline_end: the last day of the baseline period, as 'YYYY-MM-DD'
+    :param countries: the names of the countries to keep
+    :param chunksize: the number of rows read at once
+    :return: the DataFrame with the columns start_name, end_name and travel_counts
+    """
+    columns = ['ds', 'start_name', 'end_name', 'travel_counts']
+    parts = []
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        chunk = chunk.replace({'start_name': {'czech republic': 'czechia'}, 'end_name': {'czech republic': 'czechia'}})
+        chunk = chunk[(chunk.ds >= baseline_start) & (chunk.ds <= baseline_end)
+                      & chunk.start_name.isin(countries) & chunk.end_name.isin(countries)]
+        parts.append(chunk.groupby(['start_name', 'end_name'])['travel_counts'].agg(['sum', 'count']))
+    totals = pd.concat(parts).groupby(level=[0, 1]).sum()
+    totals = totals[totals['count'] > 0]
+    return (totals['sum'] / totals['count']).rename('travel_counts').reset_index()
 
-df_fb = df_fb[df_fb['end_name'].isin(['austria','belgium' ,'croatia' ,'czechia' ,'denmark',
- 'estonia' ,'finland' ,'france' ,'germany', 'greece', 'iceland', 'ireland',
- 'italy','lithuania' ,'luxembourg', 'netherlands', 'norway',
- 'romania', 'serbia', 'spain', 'sweden', 'switzerland',
- 'united kingdom', 'portugal', 'slovenia',  'hungary', 'poland',
- 'bosnia and herzegovina', 'slovakia', 'bulgaria'])]
 
-df_fb = df_fb[df_fb['start_name'].isin(['austria','belgium' ,'croatia' ,'czechia' ,'denmark',
- 'estonia' ,'finland' ,'france' ,'germany', 'greece', 'iceland', 'ireland',
- 'italy','lithuania' ,'luxembourg', 'netherlands', 'norway',
- 'romania', 'serbia', 'spain', 'sweden', 'switzerland',
- 'united kingdom', 'portugal', 'slovenia',  'hungary', 'poland',
- 'bosnia and herzegovina', 'slovakia', 'bulgaria' ])]
+def rescale(movements, scaling=None, default=4):
+    """
+    Function multiplying the travel counts of each pair of countries by its rescaling factor, the Facebook users being
+    only a fraction of the travellers
+    :param movements: the DataFrame with the columns start_name, end_name and travel_counts
+    :param scaling: the DataFrame with the columns Origin, Destination and rescaling, or the path of its csv file, None
+    to use the default factor for every pair
+    :param default: the rescaling factor of the pairs missing from scaling
+    :return: the DataFrame with the rescaled travel counts
+    """
+    movements = movements.copy()
+    if scaling is None:
+        movements['travel_counts'] = movements['travel_counts'] * default
+        return movements
+    if isinstance(scaling, str):
+        scaling = pd.read_csv(scaling)
+    factor = pd.merge(movements[['start_name', 'end_name']], scaling, how='left', left_on=['start_name', 'end_name'],
+                      right_on=['Origin', 'Destination'])['rescaling'].fillna(default)
+    movements['travel_counts'] = movements['travel_counts'].values * factor.values
+    return movements
 
 
-baseline_start = '2020-02-29'
-baseline_end = '2020-03-06'
+def symmetrize(movements):
+    """
+    Function computing the traffic between each pair of countries as the mean of the travel counts in both directions, a
+    missing direction counting as 0, and creating the migration matrix
+    :param movements: the DataFrame with the columns start_name, end_name and travel_counts
+    :return: the migration matrix as a DataFrame indexed by start_name with one column per end_name
+    """
+    reverse = movements.rename(columns={'start_name': 'end_name', 'end_name': 'start_name',
+                                        'travel_counts': 'reverse_counts'})
+    movements = pd.merge(movements, reverse, how='left', on=['start_name', 'end_name'])
+    movements['traffic'] = (movements['travel_counts'] + movements['reverse_counts'].fillna(0.0)) / 2
+    return movements.pivot_table(columns='end_name', index='start_name', values='traffic').fillna(0.0)
+
+
+def build_migration_matrix(path, baseline_start=baseline_start, baseline_end=baseline_end, scaling=None, default=4,
+                           countries=countries_name, chunksize=1_000_000):
+    """
+    Function creating the baseline migration matrix from the Facebook movement data, see read_movements, rescale and
+    symmetrize
+    :return: the migration matrix as a DataFrame indexed by start_name with one column per end_name
+    """
+    movements = read_movements(path, baseline_start, baseline_end, countries, chunksize)
+    return symmetrize(rescale(movements, scaling, default))
+
+
+def build_daily_migration(path, out, scaling=None, default=4, countries=countries_name, start=None, end=None,
+                          chunksize=1_000_000, block=64):
+    """
+    Function creating the daily migration matrices from the Facebook movement data, with the same rescaling and
+    symmetrization as the baseline migration matrix but without averaging over the days. The matrices are written in a
+    .npy file of shape (days, n, n) that can be memory-mapped, see load_daily_migration of data.py, and the dates and the
+    countries in a .json file with the same name. The days without any movement record get the matrix of the previous
+    day.
+    :param path: the path of the csv file with the columns ds, start_name, end_name and travel_counts
+    :param out: the path of the .npy file to create
+    :param scaling: the DataFrame with the columns Origin, Destination and rescaling, or the path of its csv file, None
+    to use the default factor for every pair
+    :param default: the rescaling factor of the pairs missing from scaling
+    :param countries: the names of the countries, the matrices follow their alphabetical order like migration_matrix.csv
+    :param start: the first day to keep, as 'YYYY-MM-DD', by default the first day of the file
+    :param end: the last day to keep, as 'YYYY-MM-DD', by default the last day of the file
+    :param chunksize: the number of rows read at once
+    :param block: the number of days written at once
+    :return: the list of the dates of the matrices
+    """
+    columns = ['ds', 'start_name', 'end_name', 'travel_counts']
+    parts = []
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+        chunk = chunk.replace({'start_name': {'czech republic': 'czechia'}, 'end_name': {'czech republic': 'czechia'}})
+        keep = chunk.start_name.isin(countries) & chunk.end_name.isin(countries)
+        if start is not None:
+            keep &= chunk.ds >= start
+        if end is not None:
+            keep &= chunk.ds <= end
+        parts.append(chunk[keep].groupby(['ds', 'start_name', 'end_name'])['travel_counts'].agg(['sum', 'count']))
+    totals = pd.concat(parts).groupby(level=[0, 1, 2]).sum()
+    totals = totals[totals['count'] > 0]
+    movements = (totals['sum'] / totals['count']).rename('travel_counts').reset_index()
+    movements = rescale(movements, scaling, default)
+
+    names = sorted(countries)
+    dates = pd.date_range(movements.ds.min(), movements.ds.max()).strftime('%Y-%m-%d')
+    d = dates.get_indexer(movements.ds)
+    i = pd.Index(names).get_indexer(movements.start_name)
+    j = pd.Index(names).get_indexer(movements.end_name)
+    order = np.argsort(d, kind='stable')
+    d, i, j, counts = d[order], i[order], j[order], movements['travel_counts'].values[order]
+    observed = np.zeros(len(dates), dtype=bool)
+    observed[d] = True
+
+    n = len(names)
+    tmp = out + '.tmp.npy'
+    tensor = np.lib.format.open_memmap(tmp, mode='w+', dtype=float, shape=(len(dates), n, n))
+    bounds = np.searchsorted(d, np.arange(0, len(dates) + block, block))
+    for k, first in enumerate(range(0, len(dates), block)):
+        rows = slice(bounds[k], bounds[k + 1])
+        A = np.zeros((min(block, len(dates) - first), n, n))
+        present = np.zeros(A.shape, dtype=bool)
+        A[d[rows] - first, i[rows], j[rows]] = counts[rows]
+        present[d[rows] - first, i[rows], j[rows]] = True
+        # traffic of a pair : mean of the travel counts in both directions, a missing direction counting as 0
+        tensor[first:first + A.shape[0]] = np.where(present, (A + A.transpose(0, 2, 1)) / 2, 0.0)
+    for t in np.nonzero(~observed)[0]:
+        tensor[t] = tensor[t - 1]
+    tensor.flush()
+    del tensor
+    os.replace(tmp, out)
+    with open(os.path.splitext(out)[0] + '.json', 'w') as f:
+        json.dump({'dates': list(dates), 'countries': names}, f)
+    return list(dates)
+
 
-migration_matrix = df_fb[df_fb.date <= baseline_end]
-migration_matrix = migration_matrix[migration_matrix.date >= baseline_start]
-migration_matrix = migration_matrix.groupby(['start_name', 'end_name']).agg({'travel_counts': 'mean'}).reset_index()
-
-df_scaling = pd.read_csv('../data/scaling.csv')
-migration_matrix = pd.merge(migration_matrix, df_scaling, how='left', left_on=['start_name','end_name'],
-                            right_on=['Origin','Destination'])
-
-migration_matrix['rescaling'] = migration_matrix['rescaling'].fillna(4)
-migration_matrix['travel_counts'] = migration_matrix['travel_counts']*migration_matrix['rescaling']
-
-migration_matrix['traffic'] = 0
-for index, row in migration_matrix.iterrows():
-    val1 = row['travel_counts']
-    val2 = migration_matrix.loc[(migration_matrix.start_name==row['end_name'])&(migration_matrix.end_name==row['start_name'])]['travel_counts'].values
-    if len(val2) > 0:
-        val2 = val2[0]
-    else:
-        val2 = 0.0
-    migration_matrix['traffic'].loc[index] = (val1+val2)/2
-migration_matrix = migration_matrix.pivot_table(columns='end_name', index='start_name', values='traffic').fillna(0.0)
-migration_matrix.to_csv('../data/migration_matrix.csv')
+if __name__ == '__main__':
+    migration_matrix = build_migration_matrix('../data/movement_countries.csv', scaling='../data/scaling.csv')
+    migration_matrix.to_csv('../data/migration_matrix.csv')
@@ -1,134 +1,148 @@
 import plotly.graph_objs as go
 import colorlover
-import pandas as pd
 import plotly.express as px
 from Country import *
+import metrics
+import profiling
 import dash_html_components as html
 
-def flow_arrows(fig, mig, countries, title, day, color="yellow"):
+@profiling.timed('flow_arrows')
+def flow_arrows(fig, mig, countries, title, day, color="yellow", threshold=15000, buckets=6):
     """
-    Method adding the arrows representing the importance of migration flux between european countries to map
+    Method adding the arrows representing the importance of migration flux between european countries to map. The
+    lines are grouped by width in a few traces, each trace drawing its lines separated by None.
+    :param threshold: the minimum number of daily movers of a drawn line
+    :param buckets: the number of widths of the lines
     """
-    for i, c1 in enumerate(countries):
-        for j, c2 in enumerate(countries):
-            if c1 < c2:
-                flow_c1_c2 = mig[day][i][j]
-                if flow_c1_c2 > 15000:
-                    fig.add_trace(go.Scattergeo(
-                        lat=[latitude[c1], latitude[c2]],
-                        lon=[longitude[c1], longitude[c2]],
-                        mode='lines',
-                        line=dict(width=flow_c1_c2 / 80000, color=color),
-                        showlegend=False,
-                    ))
+    flows = np.asarray(mig[day], dtype=float)
+    names = np.array(countries)
+    lat = np.array([latitude[c] for c in countries])
+    lon = np.array([longitude[c] for c in countries])
+    i, j = np.nonzero((names[:, None] < names[None, :]) & (flows > threshold))
+    if i.shape[0] == 0:
+        return
+    width = flows[i, j] / 80000
+    edges = np.geomspace(width.min(), width.max() * (1 + 1e-9), buckets + 1)
+    bucket = np.searchsorted(edges, width, side='right') - 1
+    for b in np.unique(bucket):
+        k = bucket == b
+        # one segment per line : start, end and a gap
+        fig.add_trace(go.Scattergeo(
+            lat=np.stack([lat[i[k]], lat[j[k]], np.full(k.sum(), None)], axis=1).ravel(),
+            lon=np.stack([lon[i[k]], lon[j[k]], np.full(k.sum(), None)], axis=1).ravel(),
+            mode='lines',
+            line=dict(width=float(width[k].mean()), color=color),
+            showlegend=False,
+        ))
+
+
+# europe map without the migration flows, built once by _base_map
+_base_maps = {}
+
+
+def _base_map():
+    """
+    Function creating the europe map with the countries, shared by every figure of plot_mig
+    """
+    if 'map' not in _base_maps:
+        fig = go.Figure()
+        fig.add_trace(go.Scattergeo(
+            locationmode='USA-states',
+            lon=df_countries['Longitude'],
+            lat=df_countries['Latitude'],
+            text=df_countries['ISO 3166 Country Code'],
+            textfont={"color": 'black',
+                      "family": 'Times New Roman',
+                      "size": 14},
+            textposition="top center",
+            name="Country",
+            showlegend=False,
+            mode="markers+text",
+            marker=dict(
+                size=10,
+                color="black",
+                line_color='black',
+                line_width=0.5,
+                sizemode='area')))
+
+        fig.update_layout(
+            # geo_scope='europe',
+            ###ZOOM part, but doesn't work ###
+            geo=go.layout.Geo(
+                scope='europe',
+                projection=go.layout.geo.Projection(
+                    type='azimuthal equal area',
+                    scale=1.7
+                ),
+                center={'lat': 52, 'lon': 7},
+                showland=True,
+                landcolor='rgb(243, 243, 243)',
+                countrycolor='rgb(204, 204, 204)', )
+        )
 
+        fig.update_layout(template="plotly_white", margin=dict(l=0, r=0, t=40, b=0))
+        _base_maps['map'] = fig.to_dict()
+    return _base_maps['map']
 
 
+@profiling.timed('plot_mig')
 def plot_mig(mig, countries, title, day=horizon-1):
     """
     Function creating the europe map
     """
-    fig = go.Figure()
-    fig.add_trace(go.Scattergeo(
-        locationmode='USA-states',
-        lon=df_countries['Longitude'],
-        lat=df_countries['Latitude'],
-        text=df_countries['ISO 3166 Country Code'],
-        textfont={"color": 'black',
-                  "family": 'Times New Roman',
-                  "size": 14},
-        textposition="top center",
-        name="Country",
-        showlegend=False,
-        mode="markers+text",
-        marker=dict(
-            size=10,
-            color="black",
-            line_color='black',
-            line_width=0.5,
-            sizemode='area')))
-
-    fig.update_layout(
-        # geo_scope='europe',
-        ###ZOOM part, but doesn't work ###
-        geo=go.layout.Geo(
-            scope='europe',
-            projection=go.layout.geo.Projection(
-                type='azimuthal equal area',
-                scale=1.7
-            ),
-            center={'lat': 52, 'lon': 7},
-            showland=True,
-            landcolor='rgb(243, 243, 243)',
-            countrycolor='rgb(204, 204, 204)', )
-    )
-
-    fig.update_layout(template="plotly_white", margin=dict(l=0, r=0, t=40, b=0))
-
+    fig = go.Figure(_base_map())
     flow_arrows(fig, mig, countries, title, day)
     return fig
 
-def continuous_to_discrete(x):
-    if x < 5:
-        return '< 5'
-    elif x < 10:
-        return '[5,10['
-    elif x < 15:
-        return '[10,15['
-    elif x < 25:
-        return '[15,25['
-    elif x < 35:
-        return '[25,35['
-    elif x < 50:
-        return '[35,50['
-    else:
-        return '>= 50'
+
+# classes of the delays of the peaks of add_I_map_day and their colors
+peak_delay_classes = ['< 5','[5,10[','[10,15[','[15,25[','[25,35[','[35,50[', '>= 50']
+peak_delay_colors = ['#990000', '#d7301f', '#ef6548', '#fc8d59', '#fdbb84', '#fdd49e', '#fef0d9']
 
 
+@profiling.timed('add_I_map_day')
 def add_I_map_day(base_fig,I,countries,origin='united kingdom',max_t=60):
     """
-    Function adding the colors of each country in the europe map depending on their date of the peak of the infection
+    Function adding the colors of each country in the europe map depending on their date of the peak of the infection.
+    The countries of each class of delay are drawn by one choropleth trace.
     """
-    t_baseline = I[countries.index(origin)].index(max(I[countries.index(origin)]))
-    data = [[countries[i],df_countries['iso_code'].loc[countries[i]],I[i].index(max(I[i]))-t_baseline,max(I[i]),df_countries['population'].loc[countries[i]]] for i in range(len(I))]
-    df = pd.DataFrame(data,columns=['location','ISO3','t','I','pop'])
-    df['I_prop'] = df['I'] / df['pop']
-    df['t_discrete'] = df['t'].apply(continuous_to_discrete)
-    fig = px.choropleth(df,
-                       locations="ISO3",
-                       color='t_discrete',
-                       color_discrete_map={
-                                    '< 5': '#990000',
-                                    '[5,10[' : '#d7301f',
-                                    '[10,15[' : '#ef6548',
-                                    '[15,25[' : '#fc8d59',
-                                    '[25,35[' : '#fdbb84',
-                                    '[35,50[' : '#fdd49e',
-                                    '>= 50' : '#fef0d9'},
-                       category_orders={'t_discrete': ['< 5','[5,10[','[10,15[','[15,25[','[25,35[','[35,50[', '>= 50']},
-                       center={"lat": 48.50855119, "lon": 13.0},
-                       hover_name='t',
-                       hover_data=["location", "I","pop","I_prop"],
-                       height=900)
-    fig.update_geos(fitbounds="locations",visible=False)
-    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0},width=1600)
-    fig.layout.coloraxis.colorbar.title = 'peak day'
-    for i in range(len(fig.data)):
-        base_fig.add_trace(fig.data[i])
+    I = np.asarray(I, dtype=float).T
+    t = metrics.delay(metrics.peak_day(I), countries.index(origin))
+    I_max = metrics.peak_value(I)
+    pop = df_countries['population'].loc[countries].values
+    iso = df_countries['iso_code'].loc[countries].values
+    category = np.digitize(t, [5, 10, 15, 25, 35, 50])
+    for k in np.unique(category):
+        m = category == k
+        base_fig.add_trace(go.Choropleth(
+            locations=iso[m],
+            z=np.ones(m.sum()),
+            colorscale=[[0, peak_delay_colors[k]], [1, peak_delay_colors[k]]],
+            showscale=False,
+            name=peak_delay_classes[k],
+            legendgroup=peak_delay_classes[k],
+            showlegend=True,
+            customdata=np.stack([np.array(countries)[m], I_max[m], pop[m], I_max[m] / pop[m]], axis=1),
+            hovertext=t[m],
+            hovertemplate='<b>%{hovertext}</b><br>location=%{customdata[0]}<br>I=%{customdata[1]}<br>'
+                          'pop=%{customdata[2]}<br>I_prop=%{customdata[3]}<extra></extra>',
+        ))
+    base_fig.update_layout(legend_traceorder='normal')
     return base_fig
 
 
+@profiling.timed('plot_heatmap')
 def plot_heatmap(countries,I,order_countries,title):
     """
     Function ploting the heatmap with the evoluation of the rate of infected individuals in each country for the requested time period
     """
-    data = [[countries[i],j,I[i][j],df_countries['population'].loc[countries[i]]] for i in range(len(I)) for j in range(len(I[0]))]
-    df = pd.DataFrame(data,columns=['location','t','I','pop'])
-    df['I_prop'] = df['I'] / df['pop']
-    df = df.pivot('location','t','I_prop')
-    df = df.loc[order_countries,:]
-    fig = px.imshow(df,labels=dict(x="Time (in days)", y="Country", color="% infected population"),
-                   width=1200, height=600,color_continuous_scale='YlOrRd')
+    order = [countries.index(c) for c in order_countries]
+    I = np.asarray(I, dtype=float)[order]
+    # single precision is enough for the colors and halves the size of the figure
+    I_prop = (I / df_countries['population'].loc[list(order_countries)].values[:, None]).astype(np.float32)
+    fig = px.imshow(I_prop, y=list(order_countries),
+                    labels=dict(x="Time (in days)", y="Country", color="% infected population"),
+                    width=1200, height=600,color_continuous_scale='YlOrRd')
     fig.update_layout(font=dict(size=20),yaxis = dict(tickfont = dict(size=18)))#,xaxis = dict(tickfont = dict(size=20)))
     return fig
 
@@ -0,0 +1,241 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# True while at least one Run is recording, read by the hooks before doing anything else
+enabled = False
+_active = []
+_lock = threading.Lock()
+_start = time.perf_counter()
+
+
+class _NullPhase:
+    # shared context manager of the phases while the profiling is disabled
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _record(self.name, self.begin, end - self.begin)
+        return False
+
+
+def phase(name):
+    """
+    Function timing a phase of the computation, as in : with profiling.phase('migration'): ...
+    When no Run is recording, a shared context manager doing nothing is returned.
+    :param name: the name of the phase
+    :return: the context manager
+    """
+    if not enabled:
+        return _null_phase
+    return _Phase(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as the phase name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def wrap(name, function):
+    """
+    Function returning function timed as the phase name while a Run is recording, or function itself otherwise. It is
+    called once before a hot loop, so that the loop costs nothing more when the profiling is disabled.
+    """
+    if not enabled:
+        return function
+    return timed(name)(function)
+
+
+def count(name, value=1):
+    """
+    Function incrementing a counter (days stepped, pair exchanges, cache hits, ...) of the recording runs
+    """
+    if not enabled:
+        return
+    now = time.perf_counter()
+    with _lock:
+        for run in _active:
+            run._count(name, value, now)
+
+
+def _record(name, begin, duration):
+    tid = threading.get_ident()
+    with _lock:
+        for run in _active:
+            run._phase(name, begin, duration, tid)
+
+
+class Run:
+    """
+    The class object recording the phases and the counters of the computations run between its start and its stop, in
+    every thread of the process, as in : with profiling.Run('refresh') as run: ... then run.report().
+    The totals of the phases are always kept, only the first max_events individual events are kept for the trace.
+    """
+    def __init__(self, name='run', max_events=100000):
+        """
+        Construction method
+        :param name: the name of the run, in its report
+        :param max_events: the maximum number of events kept for the Chrome trace
+        """
+        self.name = name
+        self.max_events = max_events
+        self.phases = {}
+        self.counters = {}
+        self.events = []
+        self.dropped = 0
+        self.begin = self.end = None
+
+    def start(self):
+        global enabled
+        self.begin = time.perf_counter()
+        with _lock:
+            _active.append(self)
+            enabled = True
+        return self
+
+    def stop(self):
+        global enabled
+        with _lock:
+            if self in _active:
+                _active.remove(self)
+            enabled = bool(_active)
+        self.end = time.perf_counter()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def _event(self, event):
+        if len(self.events) < self.max_events:
+            self.events.append(event)
+        else:
+            self.dropped += 1
+
+    def _phase(self, name, begin, duration, tid):
+        stats = self.phases.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        self._event(('X', name, begin, duration, tid))
+
+    def _count(self, name, value, now):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self._event(('C', name, now, self.counters[name], 0))
+
+    def report(self):
+        """
+        Method summarizing the run
+        :return: a dictionary with the name and the wall time of the run, for each phase its number of calls, its total
+        and maximum time in seconds and its share of the wall time (the nested phases are counted in their parents
+        too), and the counters
+        """
+        end = time.perf_counter() if self.end is None else self.end
+        wall = end - self.begin
+        phases = {name: {'calls': calls, 'seconds': total, 'max_seconds': longest,
+                         'share': total / wall if wall > 0 else 0.0}
+                  for name, (calls, total, longest) in sorted(self.phases.items(), key=lambda p: -p[1][1])}
+        return {'name': self.name, 'wall_seconds': wall, 'phases': phases, 'counters': dict(self.counters),
+                'dropped_events': self.dropped}
+
+    def chrome_trace(self, path=None):
+        """
+        Method exporting the events of the run in the Trace Event Format, to be opened in chrome://tracing or Perfetto
+        :param path: the file to write, None to only return the trace
+        :return: the dictionary of the trace
+        """
+        pid = os.getpid()
+        events = []
+        for kind, name, begin, value, tid in self.events:
+            event = {'name': name, 'ph': kind, 'ts': (begin - _start) * 1e6, 'pid': pid, 'tid': tid}
+            if kind == 'X':
+                event['dur'] = value * 1e6
+            else:
+                event['args'] = {name: value}
+            events.append(event)
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'run': self.name}}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+
+def instrument_dash(server, logger=None, trace_dir=None, keep=50):
+    """
+    Function recording a Run for every callback request of a Dash app, logging its latency and its main phases, and
+    adding the route GET /_profile returning the reports of the last callbacks. The phases of the other threads, such as
+    the background jobs, are recorded by the callbacks running at the same time.
+    :param server: the Flask server of the Dash app
+    :param logger: the logger of the latencies, by default the logger of this module
+    :param trace_dir: if given, the directory in which the Chrome trace of every callback is written
+    :param keep: the number of reports returned by /_profile
+    """
+    from flask import g, request, jsonify
+
+    logger = logging.getLogger(__name__) if logger is None else logger
+    reports = deque(maxlen=keep)
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+
+    @server.before_request
+    def start_run():
+        if request.path.endswith('_dash-update-component'):
+            body = request.get_json(silent=True) or {}
+            g.profiling_run = Run('callback ' + str(body.get('output', '?'))).start()
+
+    @server.after_request
+    def stop_run(response):
+        run = g.pop('profiling_run', None)
+        if run is not None:
+            report = run.stop().report()
+            reports.append(report)
+            phases = ', '.join('{} {:.1f} ms'.format(name, p['seconds'] * 1e3)
+                               for name, p in list(report['phases'].items())[:4])
+            logger.info('%s: %.1f ms (%s)', run.name, report['wall_seconds'] * 1e3, phases)
+            if trace_dir is not None:
+                run.chrome_trace(os.path.join(trace_dir, 'callback_{}_{}.json'.format(time.time_ns(), os.getpid())))
+        return response
+
+    @server.teardown_request
+    def drop_run(error):
+        # a callback failing before after_request must not leave its run recording
+        run = g.pop('profiling_run', None)
+        if run is not None:
+            run.stop()
+
+    @server.route('/_profile')
+    def profile_reports():
+        return jsonify(list(reports))
@@ -0,0 +1,200 @@
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+
+from cache import fingerprint
+
+# columns of the parameter index, one value per scenario
+index_columns = ('origin', 'beta', 'gamma', 'I0', 'spec')
+
+
+def edits_spec(edits):
+    """
+    Function computing the hash of the corridor edits of a scenario (see apply_edits), used as its spec in the index
+    :param edits: a sequence of tuples (i, j, factor, t)
+    :return: the hexadecimal digest
+    """
+    return fingerprint(tuple((int(i), int(j), float(factor), int(t)) for i, j, factor, t in edits))
+
+
+class ResultStore:
+    """
+    The class object representing an on-disk store of simulated trajectories, so that the sweeps, the analyses and the
+    dashboard can query the scenarios already simulated instead of running them again.
+    The trajectories are stored by chunks of scenarios, as arrays of shape (scenarios, Horizon, n, compartments), and
+    the index file index.jsonl has one line per chunk giving the parameters of each scenario : origin, beta, gamma, I0
+    and spec, the hash of the migration of the scenario (its corridor edits, see edits_spec, or the digest of its
+    MigrationSchedule). Every append writes the chunk under a unique name, then adds its line to the index in a single
+    write on the file opened in append mode, so that several processes can append to the same store without lock and
+    the readers never see a partial chunk. The readers only parse the lines added since their last query.
+    The uncompressed chunks (.npy) are memory-mapped by the readers, which get slices of them without copy, the
+    compressed chunks (.npz) are smaller but decompressed on each read.
+    """
+    def __init__(self, directory, compartments=('I',), dtype='float32', compress=False, chunk_size=256):
+        """
+        Construction method
+        :param directory: the directory of the store, shared by the processes
+        :param compartments: the names of the compartments stored, in the order of the last axis of the chunks
+        :param dtype: the type of the stored values, 'float32' or 'float64'
+        :param compress: if True, the chunks appended by this object are compressed, otherwise they are memory-mapped
+        by the readers
+        :param chunk_size: the maximum number of scenarios of a chunk
+        """
+        self.directory = directory
+        self.compartments = tuple(compartments)
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        self._chunks = []
+        self._offset = 0
+        self._arrays = {}
+        self._index = {name: np.zeros(0, dtype=object if name == 'spec' else float) for name in index_columns}
+        self._chunk = np.zeros(0, dtype=int)
+        self._row = np.zeros(0, dtype=int)
+
+    def __len__(self):
+        self.refresh()
+        return self._chunk.shape[0]
+
+    def append(self, scenarios, arrays):
+        """
+        Method adding simulated scenarios to the store
+        :param scenarios: the list of scenarios, each one being a dictionary with the keys origin, beta, gamma, I0 and
+        either spec or edits, as in run_sweep
+        :param arrays: a dictionary giving for each compartment the trajectories of shape (scenarios, Horizon, n)
+        """
+        data = np.stack([np.asarray(arrays[c]) for c in self.compartments], axis=-1).astype(self.dtype, copy=False)
+        if data.shape[0] != len(scenarios):
+            raise ValueError('{} scenarios for trajectories of shape {}'.format(len(scenarios), data.shape))
+        for start in range(0, len(scenarios), self.chunk_size):
+            self._write_chunk(scenarios[start:start + self.chunk_size], data[start:start + self.chunk_size])
+
+    def _write_chunk(self, scenarios, data):
+        name = '{}_{}_{}'.format(time.time_ns(), os.getpid(), uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+        if self.compress:
+            np.savez_compressed(path + '.tmp.npz', data=data)
+            os.replace(path + '.tmp.npz', path + '.npz')
+        else:
+            np.save(path + '.tmp.npy', data)
+            os.replace(path + '.tmp.npy', path + '.npy')
+        index = {'name': name, 'shape': list(data.shape), 'compartments': list(self.compartments),
+                 'compressed': self.compress,
+                 'origin': [int(s['origin']) for s in scenarios],
+                 'beta': [float(s['beta']) for s in scenarios],
+                 'gamma': [float(s['gamma']) for s in scenarios],
+                 'I0': [float(s.get('I0', 10)) for s in scenarios],
+                 'spec': [s['spec'] if 'spec' in s else edits_spec(s.get('edits', ())) for s in scenarios]}
+        line = (json.dumps(index) + '\n').encode()
+        fd = os.open(os.path.join(self.directory, 'index.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def refresh(self):
+        """
+        Method adding to the index the chunks appended since the last refresh, by this process or another one
+        """
+        try:
+            with open(os.path.join(self.directory, 'index.jsonl'), 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # a line being written by another process is read on the next refresh
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return
+        self._offset += end
+        columns = {name: [self._index[name]] for name in index_columns}
+        chunk, row = [self._chunk], [self._row]
+        for line in data[:end].splitlines():
+            index = json.loads(line)
+            name = index['name']
+            if tuple(index['compartments']) != self.compartments:
+                raise ValueError('the chunk {} holds the compartments {}, not {}'.format(name, index['compartments'],
+                                                                                        self.compartments))
+            size = index['shape'][0]
+            for column in index_columns:
+                columns[column].append(np.array(index[column], dtype=object if column == 'spec' else float))
+            chunk.append(np.full(size, len(self._chunks)))
+            row.append(np.arange(size))
+            self._chunks.append((name, index['compressed']))
+        self._index = {name: np.concatenate(columns[name]) for name in index_columns}
+        self._chunk, self._row = np.concatenate(chunk), np.concatenate(row)
+
+    def query(self, **conditions):
+        """
+        Method searching the scenarios of the store by their parameters
+        :param conditions: a condition on each column of the index (origin, beta, gamma, I0, spec) : a value, a tuple
+        (low, high) for the values in the closed range, or a list of accepted values
+        :return: the identifiers of the matching scenarios, in the order of their appending
+        """
+        self.refresh()
+        mask = np.ones(self._chunk.shape[0], dtype=bool)
+        for column, condition in conditions.items():
+            if column not in index_columns:
+                raise ValueError('unknown column {!r}, the columns are {}'.format(column, index_columns))
+            values = self._index[column]
+            if isinstance(condition, tuple):
+                mask &= (values >= condition[0]) & (values <= condition[1])
+            elif isinstance(condition, list):
+                mask &= np.isin(values, condition)
+            else:
+                mask &= values == condition
+        return np.flatnonzero(mask)
+
+    def parameters(self, ids):
+        """
+        Method returning the parameters of scenarios of the store
+        :param ids: the identifiers of the scenarios, as returned by query
+        :return: a dictionary giving the values of each column of the index, of shape (len(ids),)
+        """
+        self.refresh()
+        return {column: self._index[column][ids] for column in index_columns}
+
+    def _chunk_array(self, k):
+        if k not in self._arrays:
+            name, compressed = self._chunks[k]
+            if compressed:
+                with np.load(os.path.join(self.directory, name + '.npz')) as f:
+                    return f['data']
+            self._arrays[k] = np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+        return self._arrays[k]
+
+    def view(self, scenario_id):
+        """
+        Method returning the trajectories of a scenario
+        :param scenario_id: the identifier of the scenario, as returned by query
+        :return: the read-only array of shape (Horizon, n, compartments), a slice of the memory-mapped chunk without
+        copy if the chunk is not compressed
+        """
+        self.refresh()
+        return self._chunk_array(self._chunk[scenario_id])[self._row[scenario_id]]
+
+    def read(self, ids, compartment=None):
+        """
+        Method reading the trajectories of several scenarios, the chunks being read once
+        :param ids: the identifiers of the scenarios, as returned by query
+        :param compartment: the name of a compartment to read only this one
+        :return: the array of shape (len(ids), Horizon, n, compartments), or (len(ids), Horizon, n) for a single
+        compartment
+        """
+        self.refresh()
+        ids = np.asarray(ids, dtype=int)
+        out = None
+        for k in np.unique(self._chunk[ids]):
+            pos = np.flatnonzero(self._chunk[ids] == k)
+            data = self._chunk_array(k)
+            data = data[..., self.compartments.index(compartment)] if compartment is not None else data
+            if out is None:
+                out = np.empty((ids.shape[0],) + data.shape[1:], dtype=data.dtype)
+            out[pos] = data[self._row[ids[pos]]]
+        if out is None:
+            raise ValueError('no scenario to read')
+        return out
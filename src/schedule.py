@@ -0,0 +1,210 @@
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+from cache import array_digest, fingerprint
+
+
+def _as_matrix(matrix):
+    """
+    Function copying a migration matrix as a float array, or as a float CSR matrix if it is sparse
+    """
+    if sp is not None and sp.issparse(matrix):
+        return sp.csr_matrix(matrix, dtype=float, copy=True)
+    return np.array(matrix, dtype=float)
+
+
+def _set_entry(matrix, i, j, value):
+    # avoid changing the sparsity structure of a sparse matrix for an entry staying at 0
+    if sp is not None and sp.issparse(matrix) and value == 0 and matrix[i, j] == 0:
+        return
+    matrix[i, j] = value
+
+
+class MigrationSchedule:
+    """
+    The class object representing a piecewise-constant migration matrix : instead of one matrix per time step, it
+    stores the days on which the migration changes (the breakpoints) and one matrix for each segment between two
+    breakpoints. Indexing it by a time step gives the matrix of that day, like the dense (Horizon, n, n) array.
+    The matrices can be dense arrays or, for large and sparse mobility graphs, SciPy sparse matrices.
+    """
+    def __init__(self, matrix, H):
+        """
+        Construction method
+        :param matrix: the migration matrix of shape (n, n) used for every time step, dense or sparse
+        :param H: the range of time period in terms of days of the schedule
+        """
+        self.H = H
+        # first day of each segment, the first one is always 0
+        self.starts = [0]
+        self.matrices = [_as_matrix(matrix)]
+
+    @classmethod
+    def from_dense(cls, mig, block=64):
+        """
+        Method creating a schedule from a dense migration matrix, merging the consecutive identical days. The matrices
+        of the schedule are views of the days of mig, not copies, like the ones of view : a memory-mapped or shared
+        matrix stays shared, the methods modifying the schedule replacing its matrices by modified copies.
+        :param mig: the migration matrix of shape (Horizon, n, n)
+        :param block: the number of days compared at once, bounding the memory of the comparison
+        :return: the MigrationSchedule object
+        """
+        mig = np.asarray(mig, dtype=float)
+        schedule = cls.__new__(cls)
+        schedule.H = mig.shape[0]
+        schedule.starts = [0]
+        for first in range(1, schedule.H, block):
+            last = min(first + block, schedule.H)
+            changes = np.nonzero(np.any(mig[first:last] != mig[first - 1:last - 1], axis=(1, 2)))[0] + first
+            schedule.starts += changes.tolist()
+        schedule.matrices = [mig[t] for t in schedule.starts]
+        return schedule
+
+    @property
+    def shape(self):
+        return (self.H,) + self.matrices[0].shape
+
+    def __len__(self):
+        return self.H
+
+    def segment_index(self, t):
+        """
+        Method finding the segment containing the time step t
+        :param t: the time step
+        :return: the index of the segment
+        """
+        return int(np.searchsorted(self.starts, t, side='right')) - 1
+
+    def __getitem__(self, t):
+        return self.matrices[self.segment_index(t)]
+
+    def segments(self):
+        """
+        Method listing the segments of the schedule
+        :return: a list of tuples (first day, last day + 1, migration matrix)
+        """
+        ends = self.starts[1:] + [self.H]
+        return list(zip(self.starts, ends, self.matrices))
+
+    def day_index(self, Horizon=None):
+        """
+        Method giving the index of the segment of each time step
+        :param Horizon: the number of time steps, by default the range of the schedule
+        :return: the array of shape (Horizon,) of segment indexes
+        """
+        Horizon = self.H if Horizon is None else Horizon
+        return np.searchsorted(self.starts, np.arange(Horizon), side='right') - 1
+
+    def _split(self, t):
+        """
+        Method making sure a segment starts on time step t, by splitting the segment containing it in two
+        :param t: the time step
+        :return: the index of the segment starting on time step t
+        """
+        k = self.segment_index(t)
+        if self.starts[k] == t:
+            return k
+        self.starts.insert(k + 1, t)
+        self.matrices.insert(k + 1, self.matrices[k].copy())
+        return k + 1
+
+    def set_range(self, left, right, matrix):
+        """
+        Method setting the migration matrix of every time step between left and right
+        :param left: the first time step to modify
+        :param right: the time step following the last one to modify
+        :param matrix: the migration matrix of shape (n, n)
+        """
+        right = min(right, self.H)
+        if left >= right:
+            return
+        if right < self.H:
+            self._split(right)
+        k = self._split(left)
+        end = self.segment_index(right - 1) + 1
+        self.starts[k:end] = [left]
+        self.matrices[k:end] = [_as_matrix(matrix)]
+
+    def scale(self, i, j, factor, t=0):
+        """
+        Method multiplying the number of daily movers between 2 countries for the period of time [t,Horizon], with the
+        same semantic as modify_mig : every time step from t gets the value of time step t multiplied by factor.
+        Only the segments are modified, not every time step.
+        :param i: the index of the first country
+        :param j: the index of the second country
+        :param factor: the factor by which the number of daily movers will be multiply
+        :param t: the time step from which the numbers of daily movers between the 2 countries will be modified
+        """
+        if t >= self.H:
+            return
+        k = self._split(t)
+        # the matrices may be shared with other schedules, see view
+        self.matrices[k:] = [m.copy() for m in self.matrices[k:]]
+        value = self.matrices[k][i, j] * factor
+        for m in self.matrices[k:]:
+            _set_entry(m, i, j, value)
+        value = self.matrices[k][j, i] * factor
+        for m in self.matrices[k:]:
+            _set_entry(m, j, i, value)
+
+    def first_difference(self, other):
+        """
+        Method finding the first time step on which the migration matrix of the schedule differs from the one of
+        another schedule. The matrices are only compared at the breakpoints of the two schedules.
+        :param other: the other MigrationSchedule
+        :return: the first time step with a different matrix, or None if the schedules are identical
+        """
+        for t in sorted(set(self.starts) | set(other.starts)):
+            if t >= min(self.H, other.H):
+                break
+            a, b = self[t], other[t]
+            if sp is not None and (sp.issparse(a) or sp.issparse(b)):
+                if a.shape != b.shape or (sp.csr_matrix(a) != sp.csr_matrix(b)).nnz > 0:
+                    return t
+            elif not np.array_equal(a, b):
+                return t
+        if self.H != other.H:
+            return min(self.H, other.H)
+        return None
+
+    def digest(self):
+        """
+        Method computing a content hash of the schedule, identifying it in the caches of simulation results
+        :return: the hexadecimal digest
+        """
+        return fingerprint(self.H, self.starts, [array_digest(m) for m in self.matrices])
+
+    def copy(self):
+        schedule = MigrationSchedule.__new__(MigrationSchedule)
+        schedule.H = self.H
+        schedule.starts = list(self.starts)
+        schedule.matrices = [m.copy() for m in self.matrices]
+        return schedule
+
+    def view(self):
+        """
+        Method creating a copy of the schedule sharing its matrices, such as read-only memory-mapped arrays : the
+        methods modifying a schedule never modify its matrices in place but replace them by modified copies
+        """
+        schedule = MigrationSchedule.__new__(MigrationSchedule)
+        schedule.H = self.H
+        schedule.starts = list(self.starts)
+        schedule.matrices = list(self.matrices)
+        return schedule
+
+    def __mul__(self, factor):
+        schedule = self.copy()
+        schedule.matrices = [m * factor for m in schedule.matrices]
+        return schedule
+
+    __rmul__ = __mul__
+
+    def to_dense(self):
+        """
+        Method creating the dense migration matrix of shape (Horizon, n, n) of the schedule
+        """
+        matrices = [m.toarray() if sp is not None and sp.issparse(m) else m for m in self.matrices]
+        return np.stack(matrices)[self.day_index()]
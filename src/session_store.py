@@ -0,0 +1,116 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from schedule import MigrationSchedule
+
+
+class SessionStore:
+    """
+    The class object representing the migration schedules edited by the sessions of the Dash app, shared by every
+    worker process of the server through a directory. The baseline schedule is written once as .npy files that every
+    worker memory-maps read-only, and each session only stores the entries of its schedule which differ from the
+    baseline, so that a session costs a few bytes until it is edited and any worker can serve any session.
+    """
+    def __init__(self, directory, baseline, ttl=86400.0):
+        """
+        Construction method
+        :param directory: the directory of the store, shared by the worker processes
+        :param baseline: the baseline MigrationSchedule, with dense matrices
+        :param ttl: the number of seconds after which a session which has not been modified is removed, see expire
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self._expired = time.time()
+        os.makedirs(os.path.join(directory, 'sessions'), exist_ok=True)
+        prefix = os.path.join(directory, 'baseline_' + baseline.digest())
+        matrices = []
+        for k, matrix in enumerate(baseline.matrices):
+            path = '{}_{}.npy'.format(prefix, k)
+            if not os.path.exists(path):
+                tmp = '{}.{}.tmp.npy'.format(path, os.getpid())
+                np.save(tmp, np.asarray(matrix, dtype=float))
+                os.replace(tmp, path)
+            matrices.append(np.load(path, mmap_mode='r'))
+        self.baseline = MigrationSchedule.__new__(MigrationSchedule)
+        self.baseline.H = baseline.H
+        self.baseline.starts = list(baseline.starts)
+        self.baseline.matrices = matrices
+
+    def _path(self, session_id):
+        # the identifiers are generated by the app, the check only prevents writing outside of the directory
+        if not session_id or not all(c.isalnum() or c == '-' for c in session_id):
+            raise ValueError('invalid session identifier {!r}'.format(session_id))
+        return os.path.join(self.directory, 'sessions', session_id + '.json')
+
+    def get(self, session_id):
+        """
+        Method creating the migration schedule of a session from the baseline and the stored differences
+        :param session_id: the identifier of the session, None for the baseline
+        :return: the MigrationSchedule, sharing the unmodified matrices of the baseline
+        """
+        schedule = self.baseline.view()
+        if session_id is None:
+            return schedule
+        try:
+            with open(self._path(session_id)) as f:
+                deltas = json.load(f)
+        except FileNotFoundError:
+            return schedule
+        for left, right, i, j, value in deltas:
+            matrix = np.array(self.baseline[left])
+            matrix[i, j] = value
+            schedule.set_range(left, right, matrix)
+        return schedule
+
+    def put(self, session_id, schedule):
+        """
+        Method storing the migration schedule of a session as its differences with the baseline, computed on each
+        interval on which both schedules are constant
+        :param session_id: the identifier of the session
+        :param schedule: the MigrationSchedule of the session
+        """
+        if time.time() - self._expired > self.ttl / 10:
+            self.expire()
+        starts = sorted(set(self.baseline.starts) | set(schedule.starts))
+        deltas = []
+        for left, right in zip(starts, starts[1:] + [self.baseline.H]):
+            i, j = np.nonzero(np.asarray(schedule[left]) != self.baseline[left])
+            if i.shape[0] > 0:
+                deltas.append([left, right, i.tolist(), j.tolist(), np.asarray(schedule[left])[i, j].tolist()])
+        path = self._path(session_id)
+        if not deltas:
+            self.reset(session_id)
+            return
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(deltas, f)
+        os.replace(tmp, path)
+
+    def reset(self, session_id):
+        """
+        Method giving back the baseline schedule to a session
+        """
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def expire(self, max_age=None):
+        """
+        Method removing the sessions which have not been modified for max_age seconds, and the temporary files left by
+        the processes which died while writing. It is called by put every tenth of the ttl.
+        :param max_age: the age in seconds, by default the ttl of the store
+        """
+        max_age = self.ttl if max_age is None else max_age
+        folder = os.path.join(self.directory, 'sessions')
+        self._expired = now = time.time()
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,160 @@
+from contextlib import nullcontext
+from multiprocessing import Pool
+
+import numpy as np
+
+from schedule import MigrationSchedule
+
+# number of replicates drawn from the same random stream, the streams being derived from the seed and their index so
+# that the results depend neither on chunk_size nor on the number of processes
+stream_size = 50
+
+
+def _movers_probabilities(mig, N, Horizon):
+    """
+    Function computing for each segment of the migration matrix the probability for an individual of each country to
+    move to each other country during a day, the last column being the probability to stay
+    :return: the probabilities of shape (number of segments, n, n + 1) and the segment index of each time step
+    """
+    if isinstance(mig, MigrationSchedule):
+        day = mig.day_index(Horizon)
+        matrices = np.stack(mig.matrices[:day[-1] + 1])
+    else:
+        matrices, day = np.asarray(mig, dtype=float)[:Horizon], np.arange(Horizon)
+    prop = matrices / N[:, None]
+    idx = np.arange(N.shape[0])
+    prop[:, idx, idx] = 0.0
+    stay = np.clip(1.0 - prop.sum(axis=-1, keepdims=True), 0.0, 1.0)
+    return np.concatenate([prop, stay], axis=-1), day
+
+
+def _histogram_quantiles(hist, edges, q):
+    """
+    Function computing quantiles from histograms, interpolating linearly inside the bins
+    :param hist: the counts of shape (..., number of bins)
+    :param edges: the edges of the bins, of shape (number of bins + 1,)
+    :param q: the quantiles to compute, between 0 and 1
+    :return: the quantiles of shape (len(q), ...)
+    """
+    cum = np.cumsum(hist, axis=-1)
+    total = cum[..., -1:]
+    out = []
+    for quantile in q:
+        target = quantile * total
+        k = np.minimum((cum < target).sum(axis=-1, keepdims=True), hist.shape[-1] - 1)
+        below = np.where(k > 0, np.take_along_axis(cum, np.maximum(k - 1, 0), axis=-1), 0)
+        inside = np.take_along_axis(hist, k, axis=-1)
+        frac = np.where(inside > 0, (target - below) / np.maximum(inside, 1), 0.0)
+        out.append((edges[k] + np.clip(frac, 0.0, 1.0) * (edges[k + 1] - edges[k]))[..., 0])
+    return np.array(out)
+
+
+def _run_chunk(task):
+    """
+    Function simulating one chunk of replicates, made of whole random streams, and reducing it to histograms and counts
+    """
+    N, beta, gamma, mig, I0, Horizon, streams, seed, edges, establishment = task
+    pvals, day = _movers_probabilities(mig, N, Horizon)
+    results = [_run_stream(N, beta, gamma, pvals, day, I0, Horizon, replicates, seed, stream_id, edges, establishment)
+               for stream_id, replicates in streams]
+    return tuple(sum(r[k] for r in results) for k in range(4))
+
+
+def _run_stream(N, beta, gamma, pvals, day, I0, Horizon, replicates, seed, stream_id, edges, establishment):
+    # replicates simulated together as arrays, drawn from the random stream of index stream_id
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(stream_id,)))
+    n = N.shape[0]
+    Npop = np.round(N).astype(np.int64)
+    nbins = edges.shape[0] - 1
+
+    I = np.broadcast_to(np.round(I0).astype(np.int64), (replicates, n)).copy()
+    S = Npop - I
+    R = np.zeros((replicates, n), dtype=np.int64)
+    hist = np.zeros((Horizon, n, nbins), dtype=np.int64)
+    total = np.zeros((Horizon, n))
+    established = I >= establishment
+    offsets = np.arange(n) * nbins
+
+    def record(t):
+        bins = np.clip(np.searchsorted(edges, I, side='right') - 1, 0, nbins - 1)
+        hist[t] = np.bincount((bins + offsets).ravel(), minlength=n * nbins).reshape(n, nbins)
+        total[t] = I.sum(axis=0)
+
+    record(0)
+    p_recovery = 1.0 - np.exp(-gamma)
+    for t in range(1, Horizon):
+        # local SIR step : every susceptible individual is infected with probability 1 - exp(-beta I / N)
+        p_infection = 1.0 - np.exp(-beta[t] * I / N)
+        infections = rng.binomial(S, p_infection)
+        recoveries = rng.binomial(I, p_recovery)
+        S, I, R = S - infections, I + infections - recoveries, R + recoveries
+        # migration step : the individuals of each compartment of each country are spread over the destinations
+        p = pvals[day[t]]
+        moved = []
+        for X in (S, I, R):
+            movers = rng.multinomial(X, p)
+            moved.append(movers[:, :, :n].sum(axis=1) + movers[:, :, n])
+        S, I, R = moved
+        established |= I >= establishment
+        record(t)
+    return hist, total, established.sum(axis=0), replicates
+
+
+def simulate_stochastic(N, beta, gamma, mig, I0, Horizon, replicates=1000, seed=0, chunk_size=250, processes=1,
+                        quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), establishment=100, bins=128, progress=None):
+    """
+    Function simulating replicates of a stochastic version of the Multi-Country SIR model. Each day, the infections and
+    the recoveries inside each country are binomial draws, and the movers of each compartment of each country are
+    drawn from a multinomial distribution over the destinations given by the migration matrix.
+    The replicates are simulated as arrays by groups of stream_size replicates, each group having its own random stream
+    derived from the seed and the index of the group, so that the results do not depend on chunk_size nor on the number
+    of processes. The groups are sent to the processes by chunks of about chunk_size replicates. The trajectories
+    are reduced on the fly to histograms of the number of infected individuals per day and country, so that they never
+    have to be held in memory together.
+    :param N: total population of each country, of shape (n,)
+    :param beta: contact rate of the virus, scalar or of shape (n,) or (Horizon, n) for per-day values
+    :param gamma: recovery rate of the virus, scalar or of shape (n,)
+    :param mig: the migration matrix of shape (Horizon, n, n) or a MigrationSchedule
+    :param I0: number of infected individuals in each country at time step 0, of shape (n,)
+    :param Horizon: the range period in terms of days for the simulation
+    :param replicates: the number of replicates
+    :param seed: the seed of the random streams
+    :param chunk_size: the number of replicates simulated together
+    :param processes: the number of worker processes simulating the chunks
+    :param quantiles: the quantiles of the number of infected individuals to compute
+    :param establishment: the number of infected individuals from which the virus is considered as established in a
+    country
+    :param bins: the number of logarithmic bins of the histograms used to compute the quantiles
+    :param progress: if given, function called after each chunk with the number of replicates done and the number of
+    replicates
+    :return: a dictionary with the quantiles of shape (len(quantiles), Horizon, n), the mean of shape (Horizon, n) and
+    the probability that the virus gets established in each country, of shape (n,)
+    """
+    N = np.asarray(N, dtype=float)
+    n = N.shape[0]
+    beta = np.broadcast_to(np.asarray(beta, dtype=float), (Horizon, n)) if np.ndim(beta) < 2 \
+        else np.asarray(beta, dtype=float)
+    gamma = np.asarray(gamma, dtype=float)
+    edges = np.concatenate([[0.0], np.geomspace(1.0, N.max() + 1, bins)])
+
+    streams = [(stream_id, min(stream_size, replicates - start))
+               for stream_id, start in enumerate(range(0, replicates, stream_size))]
+    per_chunk = max(1, round(chunk_size / stream_size))
+    tasks = [(N, beta, gamma, mig, np.asarray(I0, dtype=float), Horizon, streams[k:k + per_chunk], seed, edges,
+              establishment) for k in range(0, len(streams), per_chunk)]
+    hist = np.zeros((Horizon, n, bins), dtype=np.int64)
+    total = np.zeros((Horizon, n))
+    established = np.zeros(n, dtype=np.int64)
+
+    done = 0
+    with (Pool(processes) if processes != 1 else nullcontext()) as pool:
+        results = map(_run_chunk, tasks) if pool is None else pool.imap_unordered(_run_chunk, tasks)
+        for h, s, e, r in results:
+            hist += h
+            total += s
+            established += e
+            done += r
+            if progress is not None:
+                progress(done, replicates)
+    return {'quantiles': _histogram_quantiles(hist, edges, quantiles), 'q': np.array(quantiles),
+            'mean': total / replicates, 'establishment_probability': established / replicates}
@@ -0,0 +1,237 @@
+import json
+import mmap
+import os
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+from engine import simulate_batch, initial_infected
+import jit_engine
+from schedule import MigrationSchedule
+from result_store import ResultStore
+from cache import fingerprint, array_digest
+
+# state of each worker process, filled once by _init_worker
+_worker = {}
+
+
+def apply_edits(schedule, edits):
+    """
+    Function applying a list of corridor edits to a migration schedule, with the same semantic as modify_mig in
+    Country.py: from day t, the daily movers between i and j (in both directions) are multiplied by factor.
+    :param schedule: the MigrationSchedule, left untouched
+    :param edits: a sequence of tuples (i, j, factor, t)
+    :return: the schedule itself if there is no edit, otherwise a modified copy, sharing the matrices of the days before
+    the edits with schedule
+    """
+    if not edits:
+        return schedule
+    schedule = schedule.view()
+    for i, j, factor, t in edits:
+        schedule.scale(i, j, factor, t)
+    return schedule
+
+
+def pairwise_ban_scenarios(n, origin, beta, gamma=0.1, I0=10, start_days=(0,), factor=0.0):
+    """
+    Function creating the scenarios of a travel ban study : every ban of a single pair of countries starting on each of
+    the start days, for each value of beta, plus the scenarios without any ban
+    :param n: the number of countries
+    :param origin: the index of the origin country of the virus
+    :param beta: list of values of the contact rate of the virus
+    :param gamma: the recovery rate of the virus
+    :param I0: number of infected individuals in the origin country at time step 0
+    :param start_days: the days from which the bans are applied
+    :param factor: the factor by which the number of daily movers is multiplied during a ban
+    :return: the list of scenarios, each one being a dictionary with the keys origin, beta, gamma, I0 and edits
+    """
+    bans = [()] + [((i, j, factor, t),) for i in range(n) for j in range(i + 1, n) for t in start_days]
+    return [{'origin': origin, 'beta': b, 'gamma': gamma, 'I0': I0, 'edits': edits} for edits in bans for b in beta]
+
+
+def _memmap_source(array):
+    """
+    Function finding the file of a memory-mapped array, so that the workers map the same file instead of a copy of the
+    array in shared memory
+    :param array: the array, possibly a slice of a np.memmap such as the matrices of load_daily_migration
+    :return: the tuple (path, offset in bytes of the array in the file), or None if the array is not a contiguous float
+    view of a memory-mapped file
+    """
+    if not isinstance(array, np.memmap) or array.filename is None or getattr(array, '_mmap', None) is None \
+            or not array.flags.c_contiguous or array.dtype != np.dtype(float):
+        return None
+    # the offset attribute is the one of the whole mapping, which starts on a multiple of the allocation granularity
+    start = np.frombuffer(array._mmap, dtype=np.uint8).ctypes.data
+    return array.filename, array.offset - array.offset % mmap.ALLOCATIONGRANULARITY + array.ctypes.data - start
+
+
+def _init_worker(source, shape, N, Horizon, summary, stop_threshold, backend, store):
+    if source[0] == 'memmap':
+        baseline = np.memmap(source[1], dtype=float, mode='r', offset=source[2], shape=shape)
+    else:
+        # the workers share the resource tracker of the parent, which owns the segment and unlinks it
+        shm = shared_memory.SharedMemory(name=source[1])
+        _worker['shm'] = shm
+        baseline = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        baseline.flags.writeable = False
+    # the edits of the scenarios are applied on a piecewise-constant view of the baseline, whose matrices are slices of
+    # the memory-mapped file or of the shared segment, so that the workers do not copy it
+    _worker['baseline'] = MigrationSchedule.from_dense(baseline)
+    _worker['N'] = N
+    _worker['Horizon'] = Horizon
+    _worker['summary'] = summary
+    _worker['stop_threshold'] = stop_threshold
+    _worker['backend'] = backend
+    _worker['store'] = None if store is None else ResultStore(store)
+
+
+def run_scenarios(baseline, N, scenarios, Horizon, summary=True, stop_threshold=None, backend='numpy'):
+    """
+    Function simulating a list of scenarios in the current process with a single call of the batched engine, each
+    scenario having its migration schedule, shared by the scenarios with the same edits
+    :param baseline: the baseline MigrationSchedule
+    :param N: total population of each country, of shape (n,)
+    :param scenarios: the list of scenarios, as in run_sweep
+    :param Horizon: the range period in terms of days for the simulation
+    :param summary: if True, only the peak day, the peak value and the attack rate of each scenario are computed,
+    otherwise the whole trajectories of infected individuals under the key I
+    :param stop_threshold: if given, each scenario is stopped early as in simulate_batch
+    :param backend: 'numpy' for the array engine of engine.py or 'numba' for the compiled kernel of jit_engine.py
+    :return: the dictionary of the result arrays, whose first dimension is the scenario
+    """
+    run = jit_engine.simulate_batch if backend == 'numba' else simulate_batch
+    n = N.shape[0]
+    origin = np.array([s['origin'] for s in scenarios], dtype=int)
+    beta = np.array([s['beta'] for s in scenarios], dtype=float)
+    gamma = np.array([s['gamma'] for s in scenarios], dtype=float)
+    I0 = np.array([s['I0'] for s in scenarios], dtype=float)
+
+    # the engine computes the operators of a schedule shared by several scenarios once
+    schedules = {}
+    migs = []
+    for s in scenarios:
+        edits = tuple(tuple(e) for e in s.get('edits', ()))
+        if edits not in schedules:
+            schedules[edits] = apply_edits(baseline, edits)
+        migs.append(schedules[edits])
+    mig = migs[0] if len(schedules) == 1 else migs
+    out = run(N, beta, gamma, mig, initial_infected(n, origin, I0), Horizon, summary=summary,
+              stop_threshold=stop_threshold)
+    return out if summary else {'I': out}
+
+
+def _run_chunk(task):
+    chunk_id, scenarios = task
+    out = run_scenarios(_worker['baseline'], _worker['N'], scenarios, _worker['Horizon'], _worker['summary'],
+                        _worker['stop_threshold'], _worker['backend'])
+    if _worker['store'] is not None:
+        _worker['store'].append(scenarios, out)
+    return chunk_id, out
+
+
+def _chunk_file(checkpoint_dir, chunk_id):
+    return os.path.join(checkpoint_dir, 'chunk_{}.npz'.format(chunk_id))
+
+
+def _check_checkpoint(checkpoint_dir, key):
+    """
+    Function checking that the chunks of a checkpoint directory were computed for the same sweep, identified by key,
+    and marking an empty directory with it
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    path = os.path.join(checkpoint_dir, 'sweep.json')
+    try:
+        with open(path) as f:
+            previous = json.load(f)['fingerprint']
+    except FileNotFoundError:
+        previous = None
+    if previous == key:
+        return
+    if previous is not None or any(name.startswith('chunk_') for name in os.listdir(checkpoint_dir)):
+        raise ValueError('the checkpoint directory {} holds the chunks of another sweep (different scenarios, '
+                         'chunk_size, Horizon or baseline), use another directory or empty it'.format(checkpoint_dir))
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'fingerprint': key}, f)
+    os.replace(path + '.tmp', path)
+
+
+def run_sweep(baseline, N, scenarios, Horizon, processes=None, chunk_size=64, summary=True, checkpoint_dir=None,
+              progress=None, stop_threshold=None, backend='numpy', store=None):
+    """
+    Generator running a sweep of scenarios over a pool of worker processes. The baseline migration matrix is published
+    once in shared memory and every worker reads it without copy, only the parameters and the corridor edits of each
+    scenario are sent to the workers. A memory-mapped baseline, such as the daily matrices of load_daily_migration, is
+    not copied : the workers map the same file. The results are yielded in completion order.
+    :param baseline: the baseline migration matrix, of shape (Horizon, n, n)
+    :param N: total population of each country, of shape (n,)
+    :param scenarios: the list of scenarios, each one being a dictionary with the keys origin (index of the origin
+    country), beta, gamma, I0 and optionally edits, a sequence of tuples (i, j, factor, t) as in apply_edits
+    :param Horizon: the range period in terms of days for the simulation
+    :param processes: the number of worker processes, by default the number of cores
+    :param chunk_size: the number of scenarios sent to a worker at once
+    :param summary: if True, only the peak day, the peak value and the attack rate of each scenario are computed,
+    otherwise the whole trajectories of infected individuals
+    :param checkpoint_dir: if given, every finished chunk is saved in this directory and the chunks already present are
+    not computed again, so that a crashed sweep can be resumed. A directory holding the chunks of a sweep with other
+    scenarios, chunk_size, Horizon, baseline or options raises a ValueError.
+    :param progress: if given, function called with the number of scenarios done and the total number of scenarios
+    after each chunk
+    :param stop_threshold: if given, each scenario is stopped early once every country is below this number of infected
+    individuals and decreasing, as in simulate_batch
+    :param backend: 'numpy' for the array engine of engine.py or 'numba' for the compiled kernel of jit_engine.py
+    :param store: if given, the directory of a ResultStore to which the workers append the trajectories of their
+    chunks, as float32 arrays of the compartment I, requires summary False
+    :return: yields tuples (indexes of the scenarios in the list, dictionary of the result arrays of these scenarios)
+    """
+    if store is not None and summary:
+        raise ValueError('the trajectories are stored only with summary False')
+    source = _memmap_source(baseline)
+    baseline = np.asarray(baseline, dtype=float)
+    N = np.asarray(N, dtype=float)
+    chunks = [(k, list(range(start, min(start + chunk_size, len(scenarios)))))
+              for k, start in enumerate(range(0, len(scenarios), chunk_size))]
+    done = 0
+    if checkpoint_dir is not None:
+        _check_checkpoint(checkpoint_dir, fingerprint(scenarios, chunk_size, Horizon, summary, stop_threshold,
+                                                      array_digest(baseline), array_digest(N)))
+
+    todo = []
+    for chunk_id, indices in chunks:
+        if checkpoint_dir is not None and os.path.exists(_chunk_file(checkpoint_dir, chunk_id)):
+            with np.load(_chunk_file(checkpoint_dir, chunk_id)) as f:
+                out = {key: f[key] for key in f.files}
+            done += len(indices)
+            if progress is not None:
+                progress(done, len(scenarios))
+            yield indices, out
+        else:
+            todo.append((chunk_id, indices))
+    if not todo:
+        return
+
+    shm = None
+    if source is None:
+        shm = shared_memory.SharedMemory(create=True, size=baseline.nbytes)
+        np.ndarray(baseline.shape, dtype=float, buffer=shm.buf)[:] = baseline
+        source = ('shm', shm.name)
+    else:
+        source = ('memmap',) + source
+    try:
+        with Pool(processes, initializer=_init_worker,
+                  initargs=(source, baseline.shape, N, Horizon, summary, stop_threshold, backend,
+                            store)) as pool:
+            tasks = [(chunk_id, [scenarios[k] for k in indices]) for chunk_id, indices in todo]
+            indices_of = dict(todo)
+            for chunk_id, out in pool.imap_unordered(_run_chunk, tasks):
+                if checkpoint_dir is not None:
+                    tmp = _chunk_file(checkpoint_dir, chunk_id) + '.tmp.npz'
+                    np.savez(tmp, **out)
+                    os.replace(tmp, _chunk_file(checkpoint_dir, chunk_id))
+                done += len(indices_of[chunk_id])
+                if progress is not None:
+                    progress(done, len(scenarios))
+                yield indices_of[chunk_id], out
+    finally:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
@@ -1,8 +1,21 @@
+import logging
+import os
+import uuid
+
 import dash
 import dash_core_components as dcc
 import dash_table
+import pandas as pd
 from dash.dependencies import Input, Output, State
 from plot_functions import *
+from cache import ResultCache, fingerprint, sizeof
+from engine import simulate_arrays
+import metrics
+from session_store import SessionStore
+from jobs import JobQueue
+from result_store import ResultStore
+import profiling
+from api import register_api
 import dash_bootstrap_components as dbc
 
 from dash_bootstrap_templates import load_figure_template
@@ -11,7 +24,22 @@ options = []
 for country in eu_countries:
     options.append({"label": country, "value": country})
 options2 = [{"label": "all", "value": "all"}] + options
-migration_matrix = create_migration_matrix(horizon)
+# migration schedules edited by the sessions, shared by the worker processes of the server through this directory
+session_dir = os.path.join(data_dir, 'sessions')
+scenario_store = SessionStore(session_dir, create_migration_schedule(horizon))
+# simulations run in the background, polled by the dashboard
+job_workers = 2
+job_queue = JobQueue(os.path.join(data_dir, 'jobs'), max_workers=job_workers)
+# trajectories of the scenarios already simulated, kept across restarts and shared by the worker processes
+result_store = ResultStore(os.path.join(data_dir, 'results'))
+# results of the simulations already run, keyed on the fingerprint of the scenario
+cache_max_entries = 64
+cache_max_bytes = 512 * 2 ** 20
+result_cache = ResultCache(max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+# last simulation of each (origin, beta, gamma), used as checkpoint after a modification of the migration matrix
+checkpoint_cache = ResultCache(max_entries=cache_max_entries, max_bytes=cache_max_bytes)
+# scenarios simulated at startup, so that their first display is immediate
+preset_scenarios = [('united kingdom', 0.2, 0.1)]
 col = '#61BFF3'
 light = '#95D5FC'
 
@@ -22,6 +50,14 @@ load_figure_template("cerulean")
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.CERULEAN])
 
 server=app.server
+# headless simulation endpoint POST /api/simulate on the baseline migration matrix
+register_api(server, lambda: scenario_store.baseline * 1000, df_countries['population'].loc[eu_countries].values,
+             eu_countries, horizon)
+# latency and phases of every callback, logged and served on /_profile when the environment variable
+# VARIANTOOL_PROFILE is set, with the Chrome trace of every callback written in VARIANTOOL_PROFILE_TRACE if it is set
+if os.environ.get('VARIANTOOL_PROFILE'):
+    logging.basicConfig(level=logging.INFO)
+    profiling.instrument_dash(server, trace_dir=os.environ.get('VARIANTOOL_PROFILE_TRACE'))
 
 
 
@@ -46,11 +82,12 @@ def find_interval(day,markers):
             right = marker
     return left,right
 
-def keep_symmetric(day, data):
+def keep_symmetric(day, data, migration_matrix):
     """
     Method making sure the migration matrix is symmetric when it is modified
     :param day: the time step on which the matrix was modified
     :param data: value of the migration matrix on day "day"
+    :param migration_matrix: the migration schedule before the modification
     :return: the migration matrix on day "day" modified so that it is symmetrical
     """
     old_data = migration_matrix[day]
@@ -62,7 +99,7 @@ def keep_symmetric(day, data):
 
 # ------------------------------------------------------------------------------
 # App layout
-app.layout = dbc.Container(fluid=True, children=[
+layout = dbc.Container(fluid=True, children=[
     html.H1("Number of days before the peak of infection is reached per country", style={'text-align': 'center'}, className="bg-primary text-white p-2"),
     html.Div(className='row',
              style={'display': 'flex', 'background-color':col,'border': '1px solid black','borderRadius': '15px',"width":"1600px", 'margin-left':'100px','margin-top':'20px'},
@@ -175,7 +212,8 @@ app.layout = dbc.Container(fluid=True, children=[
     dcc.Tab(label='Graphs', selected_style={'background-color':col,'fontWeight':'bold'},style={'background-color':'#95D5FC'}, children=[
         html.Div(style={'display':'flex'},children=[
             html.Div(
-                [dcc.Graph(id='infection_heatmap', figure={},style={'height':'600px','width':'1200px'}),
+                [html.Div(id='job_progress', children=''),
+                 dcc.Graph(id='infection_heatmap', figure={},style={'height':'600px','width':'1200px'}),
                  html.Div([
                      html.Div(dcc.Input(id='filename_heatmap', type='text', placeholder='Enter the name of the file')),
                      html.Button('Save Heatmap as pdf', id='save_heatmap', n_clicks=0),
@@ -197,34 +235,187 @@ app.layout = dbc.Container(fluid=True, children=[
 ])
 
 
+def serve_layout():
+    """
+    Function creating the layout of each page load, with a new session identifier kept by the browser, under which the
+    modifications of the migration matrix are stored in scenario_store
+    """
+    return html.Div([dcc.Store(id='session_id', data=uuid.uuid4().hex), dcc.Store(id='job_id'),
+                     dcc.Interval(id='job_poll', interval=500, disabled=True), layout])
+
+
+app.layout = serve_layout
+
+
 # ------------------------------------------------------------------------------
 # Connect the Plotly graphs with Dash Components
 @app.callback(
     [Output(component_id='infection_map', component_property='figure'),
-     Output(component_id='infection_heatmap', component_property='figure')],
-    Input(component_id='tabs', component_property='value'),
+     Output(component_id='infection_heatmap', component_property='figure'),
+     Output(component_id='job_id', component_property='data'),
+     Output(component_id='job_poll', component_property='disabled'),
+     Output(component_id='job_progress', component_property='children')],
+    [Input(component_id='tabs', component_property='value'),
+     Input(component_id='job_poll', component_property='n_intervals')],
     [State(component_id='slct_country_origin', component_property='value'),
      State(component_id='beta', component_property='value'),
-     State(component_id='gamma', component_property='value')]
+     State(component_id='gamma', component_property='value'),
+     State(component_id='session_id', component_property='data'),
+     State(component_id='job_id', component_property='data')]
 )
-def update_graph(tab, origin_country, beta, gamma):
-    countries = create_countries(eu_countries, origin=origin_country, beta=beta, gamma=gamma, Horizon=horizon)
-
+def update_graph(tab, n_intervals, origin_country, beta, gamma, session_id, job_id):
+    """
+    Function displaying the figures of the scenario. A scenario not simulated yet is run as a background job, which is
+    then polled by the job_poll interval, showing the heatmap of the days already simulated.
+    """
+    trigger_id = dash.callback_context.triggered[0]['prop_id'].split('.')[0] if dash.callback_context.triggered else ''
+    migration_matrix = scenario_store.get(session_id)
+    key = fingerprint(origin_country, beta, gamma, horizon, migration_matrix.digest())
+    result = result_cache.get(key)
+    if result is not None:
+        return result['figures'] + (None, True, '')
+    I = stored_infected(origin_country, beta, gamma, migration_matrix)
+    if I is not None:
+        result = scenario_figures(I, migration_matrix)
+        result_cache.put(key, result)
+        return result['figures'] + (None, True, '')
+    if trigger_id != 'job_poll' or job_id is None:
+        job_id = job_queue.submit(key, simulate_infected, origin_country, beta, gamma, migration_matrix)
+    status = job_queue.status(job_id) or {'state': 'queued', 'done': 0, 'total': 0}
+    if status['state'] == 'done':
+        done = job_queue.result(job_id)
+        if done is None:
+            # another worker process stored the result and discarded the job in the meantime
+            I = stored_infected(origin_country, beta, gamma, migration_matrix)
+            if I is None:
+                return dash.no_update, dash.no_update, None, False, 'Simulated {} / {} days'.format(status['done'],
+                                                                                                  status['total'])
+        else:
+            I = done['I']
+            store_infected(origin_country, beta, gamma, migration_matrix, I)
+            # the result is now in the result store, the files of the job are no longer needed
+            job_queue.discard(job_id)
+        result = scenario_figures(I, migration_matrix)
+        result_cache.put(key, result)
+        return result['figures'] + (None, True, '')
+    if status['state'] == 'failed':
+        return dash.no_update, dash.no_update, None, True, 'The simulation failed'
+    text = 'Simulated {} / {} days'.format(status['done'], status['total'])
+    partial = job_queue.partial(job_id)
+    if partial is None:
+        return dash.no_update, dash.no_update, job_id, False, text
+    I = partial['I']
+    order_countries = [eu_countries[i] for i in np.argsort(metrics.peak_day(I.T), kind='stable')]
+    fig2 = plot_heatmap(eu_countries, I, order_countries, 'Infected rate in EU countries with baseline migration')
+    return dash.no_update, fig2, job_id, False, text
+
+
+def simulate_infected(origin_country, beta, gamma, migration_matrix, progress=None):
+    """
+    Function simulating a scenario, restarting from the last simulation of the same parameters if there is one
+    :param origin_country: country of origin of the virus
+    :param beta: contract rate of the virus
+    :param gamma: recovery rate of the virus
+    :param migration_matrix: the migration schedule, in thousands of daily movers
+    :param progress: if given, function called with the number of days simulated, the number of days and the
+    infected individuals of shape (n, days simulated) under the keyword I, as for the jobs of JobQueue
+    :return: a dictionary with the infected individuals of shape (n, Horizon) under the key 'I'
+    """
     mig = migration_matrix *1000
+    N = df_countries['population'].loc[eu_countries].values.astype(float)
+
+    # only the days from the first modification of the migration matrix since the last simulation of the same
+    # parameters are simulated again, the previous days are kept in its array of states
+    checkpoint_key = fingerprint(origin_country, beta, gamma, horizon)
+    # the checkpoint is taken out of the cache while its states are simulated again
+    checkpoint = checkpoint_cache.pop(checkpoint_key)
+    if checkpoint is None:
+        states = np.zeros((horizon, 3, len(eu_countries)))
+        states[0, 1, eu_countries.index(origin_country)] = 10
+        states[0, 0] = N - states[0, 1]
+        start = 1
+    else:
+        states, previous_mig = checkpoint
+        start = mig.first_difference(previous_mig)
+        start = horizon if start is None else start
+
+    report = None
+    if progress is not None:
+        def report(t, X):
+            progress(t + 1, horizon, I=X[:t + 1, 1].T)
+    simulate_arrays(N, beta, gamma, mig, None, None, None, horizon, start=start, states=states, progress=report)
+    checkpoint_cache.put(checkpoint_key, (states, mig), nbytes=sizeof(states) + sum(sizeof(m) for m in mig.matrices))
+    return {'I': states[:, 1].T.copy()}
+
+
+def stored_infected(origin_country, beta, gamma, migration_matrix):
+    """
+    Function reading the infected individuals of a scenario from result_store
+    :param origin_country: country of origin of the virus
+    :param beta: contract rate of the virus
+    :param gamma: recovery rate of the virus
+    :param migration_matrix: the migration schedule, in thousands of daily movers
+    :return: the infected individuals of shape (n, Horizon), or None if the scenario is not in the store
+    """
+    ids = result_store.query(origin=eu_countries.index(origin_country), beta=float(beta), gamma=float(gamma), I0=10,
+                             spec=migration_matrix.digest())
+    if ids.shape[0] == 0 or result_store.view(ids[-1]).shape[0] != horizon:
+        return None
+    return result_store.view(ids[-1])[:, :, 0].T
+
+
+def store_infected(origin_country, beta, gamma, migration_matrix, I):
+    """
+    Function adding the infected individuals of shape (n, Horizon) of a simulated scenario to result_store, unless
+    another worker process already did
+    """
+    if stored_infected(origin_country, beta, gamma, migration_matrix) is None:
+        result_store.append([{'origin': eu_countries.index(origin_country), 'beta': beta, 'gamma': gamma, 'I0': 10,
+                              'spec': migration_matrix.digest()}], {'I': np.asarray(I).T[None]})
+
+
+def scenario_figures(I, migration_matrix):
+    """
+    Function building the infection map and the heatmap of a simulated scenario
+    :param I: the infected individuals of shape (n, Horizon)
+    :param migration_matrix: the migration schedule, in thousands of daily movers
+    :return: a dictionary with the trajectories of infected individuals under the key 'I' and the infection map and
+    heatmap under the key 'figures'
+    """
+    fig1 = plot_mig(migration_matrix * 1000, eu_countries, 'Infected rate in EU countries with baseline migration')
+    fig1 = add_I_map_day(fig1, I, eu_countries)
 
-    Ires = simulate(countries, mig)
+    peaks = metrics.peak_day(np.asarray(I).T)
+    order_countries = [eu_countries[i] for i in np.argsort(peaks, kind='stable')]
+    fig2 = plot_heatmap(eu_countries, I, order_countries, 'Infected rate in EU countries with baseline migration')
+    return {'I': np.asarray(I), 'figures': (fig1, fig2)}
 
-    fig1 = plot_mig(mig, eu_countries, 'Infected rate in EU countries with baseline migration')
-    fig1 = add_I_map_day(fig1, Ires, eu_countries)
 
-    dictI = {}
-    for i, country in enumerate(eu_countries):
-        dictI[country] = Ires[i].index(max(Ires[i]))
-    dictI = dict(sorted(dictI.items(), key=lambda item: item[1]))
-    order_countries = dictI.keys()
-    fig2 = plot_heatmap(eu_countries, Ires, order_countries, 'Infected rate in EU countries with baseline migration')
+def simulate_scenario(origin_country, beta, gamma, session_id=None):
+    """
+    Function simulating a scenario with the migration matrix of a session and building its figures, or returning them
+    from the result cache if the same scenario was already simulated
+    :param origin_country: country of origin of the virus
+    :param beta: contract rate of the virus
+    :param gamma: recovery rate of the virus
+    :param session_id: the identifier of the session, None for the baseline migration matrix
+    :return: a dictionary with the trajectories of infected individuals under the key 'I' and the infection map and
+    heatmap under the key 'figures'
+    """
+    migration_matrix = scenario_store.get(session_id)
+    key = fingerprint(origin_country, beta, gamma, horizon, migration_matrix.digest())
 
-    return fig1, fig2
+    def compute():
+        I = stored_infected(origin_country, beta, gamma, migration_matrix)
+        if I is None:
+            I = simulate_infected(origin_country, beta, gamma, migration_matrix)['I']
+            store_infected(origin_country, beta, gamma, migration_matrix, I)
+        return scenario_figures(I, migration_matrix)
+    return result_cache.get_or_compute(key, compute)
+
+
+for preset in preset_scenarios:
+    simulate_scenario(*preset)
 
 
 @app.callback(
@@ -233,16 +424,16 @@ def update_graph(tab, origin_country, beta, gamma):
     Input(component_id='reset_button', component_property='n_clicks'),
     State(component_id='day_slider', component_property='value'),
     State(component_id='day_slider', component_property='marks'),
+    State(component_id='session_id', component_property='data'),
 )
-def update_slider(n_clicks_add,n_clicks_reset,day,marker):
+def update_slider(n_clicks_add,n_clicks_reset,day,marker,session_id):
     ctx = dash.callback_context
     if not ctx.triggered:
         pass
     elif 'add' in ctx.triggered[0]['prop_id']:
         marker[day[0]] = {'label' : 'Day ' + str(day[0]), 'style': {'color':'black','fontWeight': 'bold'}}
     elif 'reset' in ctx.triggered[0]['prop_id']:
-        global migration_matrix
-        migration_matrix = create_migration_matrix(horizon)
+        scenario_store.reset(session_id)
         marker = {0: {'label': 'Day 0', 'style': {'color': 'black', 'fontWeight': 'bold'}},
               horizon: {'label': 'Day ' + str(horizon), 'style': {'color': 'black', 'fontWeight': 'bold'}}}
     return marker
@@ -269,12 +460,13 @@ def update_multiplicator_explainer(country1,country2,day,markers,factor):
     State(component_id='slct_country_1', component_property='value'),
     State(component_id='slct_country_2', component_property='value'),
     State(component_id='factor', component_property='value'),
+    State(component_id='session_id', component_property='data'),
 )
-def update_matrix(day,markers,n_clicks,country1,country2,factor):
+def update_matrix(day,markers,n_clicks,country1,country2,factor,session_id):
     left, right = find_interval(day[0], markers)
     text = 'SYMMETRIC MIGRATION MATRIX : number of daily movers between 2 countries from day ' \
            + str(left) + ' to day ' + str(right) + ' in thousands'
-    data = migration_matrix[min(day[0], horizon - 1)]
+    data = np.array(scenario_store.get(session_id)[min(day[0], horizon - 1)])
     trigger_id = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
     if trigger_id == 'multiplicator_button' and n_clicks > 0:
         if country1 == 'all':
@@ -302,14 +494,16 @@ def update_matrix(day,markers,n_clicks,country1,country2,factor):
     Output(component_id='travel_map', component_property='figure'),
     Input(component_id='migration_table', component_property='data'),
     State(component_id='day_slider', component_property='value'),
-    State(component_id='day_slider', component_property='marks')
+    State(component_id='day_slider', component_property='marks'),
+    State(component_id='session_id', component_property='data')
 )
-def update_matrix(rows,day,markers):
+def update_matrix(rows,day,markers,session_id):
     left,right = find_interval(day[0],markers)
     data = pd.DataFrame(rows).drop('',axis=1).astype(float).values
-    data = keep_symmetric(day[0],data)
-    global migration_matrix
-    migration_matrix[left:right] = [data for i in range(right-left)]
+    migration_matrix = scenario_store.get(session_id)
+    data = keep_symmetric(day[0],data,migration_matrix)
+    migration_matrix.set_range(left, right, data)
+    scenario_store.put(session_id, migration_matrix)
     mig = migration_matrix * 1000
     fig = plot_mig(mig, eu_countries, '', day=day[0])
     return fig